@@ -1,16 +1,50 @@
 # file: videocaptureasync.py
 import threading
+from timeit import default_timer as timer
+
 import cv2
+import numpy as np
 
 class VideoCaptureAsync:
-    def __init__(self, src=0, width=640, height=480):
+    """Decode frames on a background thread into a preallocated ring buffer.
+
+    Every decoded frame gets a monotonic sequence number and is handed out
+    at most once. When the ring is full the 'drop_oldest' policy (live
+    cameras) overwrites the oldest unread frame, while 'block' (files) holds
+    decoding until a frame has been read. Reading blocks on a condition
+    instead of spinning, and returns no frame once the stream has ended.
+    """
+
+    def __init__(self, src=0, width=640, height=480, buffer_size=4,
+                 policy='drop_oldest'):
+        assert policy in ('drop_oldest', 'block'), \
+            'policy must be drop_oldest or block'
         self.src = src
         self.cap = cv2.VideoCapture(self.src)
         self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
         self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
-        self.grabbed, self.frame = self.cap.read()
         self.started = False
-        self.read_lock = threading.Lock()
+        self.read_lock = threading.Condition()
+        self.policy = policy
+        self.buffer_size = buffer_size
+        self.write_seq = 0  # sequence number of the next decoded frame
+        self.read_seq = 0  # sequence number of the next frame to hand out
+        self.borrowed = set()
+        self.dropped = 0
+        self.frames_read = 0
+        self.read_time = 0.
+
+        grabbed, frame = self.cap.read()
+        self.eof = not grabbed
+        self.frames = None
+        # Decode time of the frame in every slot, for latency measurements.
+        self.timestamps = np.zeros(buffer_size)
+        if grabbed:
+            self.frames = np.empty((buffer_size,) + frame.shape,
+                                   dtype=frame.dtype)
+            self.frames[0] = frame
+            self.timestamps[0] = timer()
+            self.write_seq = 1
 
     def set(self, propid, propval):
         self.cap.set(propid, propval)
@@ -18,6 +52,12 @@ class VideoCaptureAsync:
     def get(self, propid):
         return self.cap.get(propid)
 
+    @property
+    def finished(self):
+        """True once the stream has ended and every frame was handed out."""
+        with self.read_lock:
+            return self.eof and self.read_seq >= self.write_seq
+
     def start(self):
         if self.started:
             print('[!] Asynchroneous video capturing has already been started.')
@@ -27,24 +67,115 @@ class VideoCaptureAsync:
         self.thread.start()
         return self
 
-
+    def _slot_writable(self, seq):
+        overwritten = seq - self.buffer_size
+        if overwritten in self.borrowed:
+            return False
+        return self.policy == 'drop_oldest' or self.read_seq > overwritten
 
     def update(self):
-        while self.started:
-            grabbed, frame = self.cap.read()
+        try:
+            self._decode()
+        finally:
+            # Also when decoding raised (e.g. the stream changed size), so
+            # readers waiting on the condition see the end of the stream.
             with self.read_lock:
-                self.grabbed = grabbed
-                self.frame = frame
+                if self.started:
+                    self.eof = True
+                self.read_lock.notify_all()
 
-    def read(self):
+    def _decode(self):
+        while self.started and not self.eof:
+            with self.read_lock:
+                seq = self.write_seq
+                while self.started and not self._slot_writable(seq):
+                    self.read_lock.wait(0.1)
+                if not self.started:
+                    break
+                if self.read_seq <= seq - self.buffer_size:
+                    # Ring is full of unread frames, drop the oldest one.
+                    self.read_seq = seq - self.buffer_size + 1
+                    self.dropped += 1
+
+            # Nobody can read this slot until write_seq moves past it, so
+            # decode straight into it without holding the lock.
+            slot = self.frames[seq % self.buffer_size]
+            start = timer()
+            grabbed, frame = self.cap.read(slot)
+            self.read_time += timer() - start
+            if grabbed and frame is not slot:
+                slot[...] = frame
+
+            with self.read_lock:
+                if grabbed:
+                    self.timestamps[seq % self.buffer_size] = timer()
+                    self.write_seq += 1
+                    self.frames_read += 1
+                else:
+                    self.eof = True
+                self.read_lock.notify_all()
+
+    def _next_seq(self, timeout, latest):
+        # Called with read_lock held.
+        while self.read_seq >= self.write_seq:
+            if self.eof or not self.started:
+                return None
+            if not self.read_lock.wait(timeout):
+                return None
+        if latest:
+            self.dropped += self.write_seq - 1 - self.read_seq
+            self.read_seq = self.write_seq - 1
+        seq = self.read_seq
+        self.read_seq += 1
+        return seq
+
+    def read_frame(self, timeout=None, latest=False):
+        """Return (seq, frame copy) of the next unread frame.
+
+        latest skips straight to the newest decoded frame. seq is None when
+        the stream has ended, or nothing arrived within timeout.
+        """
+        with self.read_lock:
+            seq = self._next_seq(timeout, latest)
+            if seq is None:
+                return None, None
+            frame = self.frames[seq % self.buffer_size].copy()
+            self.read_lock.notify_all()
+        return seq, frame
+
+    def borrow(self, timeout=None, latest=False):
+        """Like read_frame, but return a view into the ring buffer.
+
+        The slot is not overwritten until release(seq) is called.
+        """
+        with self.read_lock:
+            seq = self._next_seq(timeout, latest)
+            if seq is None:
+                return None, None
+            self.borrowed.add(seq)
+        return seq, self.frames[seq % self.buffer_size]
+
+    def frame_time(self, seq):
+        """Decode time of a frame that is still in the ring buffer."""
+        return self.timestamps[seq % self.buffer_size]
+
+    def release(self, seq):
         with self.read_lock:
-            frame = self.frame.copy()
-            grabbed = self.grabbed
-        return grabbed, frame
+            self.borrowed.discard(seq)
+            self.read_lock.notify_all()
+
+    def read(self):
+        seq, frame = self.read_frame()
+        return seq is not None, frame
 
     def stop(self):
-        self.started = False
+        with self.read_lock:
+            self.started = False
+            self.read_lock.notify_all()
         self.thread.join()
 
+    def __enter__(self):
+        return self
+
     def __exit__(self, exec_type, exc_value, traceback):
-        self.cap.release()
\ No newline at end of file
+        self.cap.release()
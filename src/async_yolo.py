@@ -0,0 +1,47 @@
+"""
+asyncio front end for the YOLO detector
+"""
+
+import asyncio
+
+from src.batching import MicroBatcher
+
+
+class AsyncYOLO(object):
+    """Await detections without blocking the event loop.
+
+    Session calls run on the MicroBatcher worker thread, never on the loop.
+    Awaits that arrive close together are coalesced into one detect_images
+    batch. At most max_pending detections are queued or running, further
+    callers wait for a free slot, which pushes back on producers instead of
+    growing an unbounded queue.
+
+        async with AsyncYOLO(YOLO()) as detector:
+            boxes, scores, classes = await detector.detect(image)
+    """
+
+    def __init__(self, yolo, max_batch=8, max_wait=0.005, max_pending=64):
+        self.yolo = yolo
+        self.max_pending = max_pending
+        self.batcher = MicroBatcher(yolo.detect_images, max_batch=max_batch,
+                                    max_wait=max_wait).start()
+        self.slots = None
+
+    async def detect(self, image):
+        if self.slots is None:
+            # Created here so it belongs to the running loop.
+            self.slots = asyncio.Semaphore(self.max_pending)
+        async with self.slots:
+            return await asyncio.wrap_future(self.batcher.submit(image))
+
+    async def detect_images(self, images):
+        return await asyncio.gather(*[self.detect(image) for image in images])
+
+    def close(self):
+        self.batcher.stop()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,93 @@
+"""
+Dynamic micro-batching of concurrent detection requests
+"""
+
+import queue
+import threading
+from concurrent.futures import Future
+from timeit import default_timer as timer
+
+
+class MicroBatcher(object):
+    """Group concurrently submitted items into batches for one batch function.
+
+    A worker thread takes the first waiting item, then keeps collecting until
+    it has max_batch items or max_wait seconds have passed, and calls
+    batch_fn(items) once for all of them. batch_fn must return one result per
+    item. submit() returns a concurrent.futures.Future. With max_queue > 0
+    the pending queue is bounded and submit() raises queue.Full once it is
+    full, so callers can push back.
+    """
+
+    def __init__(self, batch_fn, max_batch=8, max_wait=0.01, max_queue=0):
+        self.batch_fn = batch_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.running = False
+        self.batches = 0
+        self.items = 0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        # Fail what is still queued, so no caller waits on it forever.
+        while True:
+            try:
+                _, future = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if future.set_running_or_notify_cancel():
+                future.set_exception(RuntimeError('batcher stopped'))
+
+    def submit(self, item, block=False, timeout=None):
+        if not self.running:
+            raise RuntimeError('batcher stopped')
+        future = Future()
+        self.queue.put((item, future), block, timeout)
+        return future
+
+    @property
+    def mean_batch_size(self):
+        return self.items / self.batches if self.batches else 0.
+
+    def _collect(self):
+        try:
+            batch = [self.queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = timer() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - timer()
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        # Drop requests whose caller gave up while they were queued.
+        return [(item, future) for item, future in batch
+                if future.set_running_or_notify_cancel()]
+
+    def _run(self):
+        while self.running:
+            batch = self._collect()
+            if not batch:
+                continue
+            try:
+                results = self.batch_fn([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += len(batch)
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
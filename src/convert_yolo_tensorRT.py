@@ -31,6 +31,41 @@ def _main():
         help='Number of GPU to use, default ' + str(YOLO.get_defaults("gpu_num"))
     )
 
+    parser.add_argument(
+        '--intra_op_threads', type=int,
+        help='Threads used inside one TF op, 0 lets TF decide, default ' + str(YOLO.get_defaults("intra_op_threads"))
+    )
+
+    parser.add_argument(
+        '--inter_op_threads', type=int,
+        help='TF ops run in parallel, 0 lets TF decide, default ' + str(YOLO.get_defaults("inter_op_threads"))
+    )
+
+    parser.add_argument(
+        '--graph_optimization', type=str, choices=['default', 'aggressive', 'off'],
+        help='Grappler graph optimization level, default ' + YOLO.get_defaults("graph_optimization")
+    )
+
+    parser.add_argument(
+        '--xla_jit', action="store_true",
+        help='Compile the graph with XLA JIT'
+    )
+
+    parser.add_argument(
+        '--rect_inference', action="store_true",
+        help='With --preprocess, letterbox to an aspect ratio preserving rectangle'
+    )
+
+    parser.add_argument(
+        '--preprocess', action="store_true",
+        help='Freeze with in-graph preprocessing, the model then takes raw uint8 frames'
+    )
+
+    parser.add_argument(
+        '--input_channels', type=str, choices=['RGB', 'BGR'],
+        help='Channel order of raw frames with --preprocess, default ' + YOLO.get_defaults("input_channels")
+    )
+
     parser.add_argument(
             '--save', type=str,
             help='path to save frozen model'
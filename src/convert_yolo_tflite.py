@@ -0,0 +1,110 @@
+"""
+Export a trained YOLO model to TFLite
+
+By default the .tflite returns the raw head outputs and YOLO decodes them
+with yolo3/postprocess.py. With --decode the box decoding runs inside the
+model, which then takes the original image shape as a second input and
+returns boxes and class scores ready for NMS.
+
+    python -m src.convert_yolo_tflite --save model_data/yolo.tflite
+"""
+
+import argparse
+
+import tensorflow as tf
+from keras import backend as K
+from keras.layers import Input
+
+from src.train import get_classes, get_anchors
+from src.yolo import YOLO
+from src.yolo3.model import load_yolo_body, yolo_decode
+
+
+def convert(model_path, anchors_path, classes_path, input_size=(416, 416),
+            decode=False, optimize=False):
+    """Serialized TFLite model for a fixed input_size (h, w), batch 1."""
+    K.clear_session()
+    K.set_learning_phase(0)
+    anchors = get_anchors(anchors_path)
+    num_classes = len(get_classes(classes_path))
+    model = load_yolo_body(model_path, len(anchors), num_classes)
+
+    # TFLite wants fully static shapes.
+    image_input = Input(batch_shape=(1,) + tuple(input_size) + (3,),
+                        name='image_input')
+    outputs = model(image_input)
+    inputs = [image_input]
+    if decode:
+        image_shape = K.placeholder(shape=(2,), name='image_shape')
+        boxes, box_scores = yolo_decode(outputs, anchors, num_classes,
+                                        image_shape, keep_batch=True)
+        outputs = [K.identity(boxes, name='boxes'),
+                   K.identity(box_scores, name='box_scores')]
+        inputs.append(image_shape)
+
+    converter = tf.lite.TFLiteConverter.from_session(K.get_session(), inputs,
+                                                     outputs)
+    if optimize:
+        # Weights stored as int8, dequantized by the interpreter.
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    return converter.convert()
+
+
+def _main():
+    # class YOLO defines the default value, so suppress any default here
+    parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS)
+    '''
+    Command line options
+    '''
+    parser.add_argument(
+        '--model_path', type=str,
+        help='path to model weight file, default ' + YOLO.get_defaults("model_path")
+    )
+
+    parser.add_argument(
+        '--anchors_path', type=str,
+        help='path to anchor definitions, default ' + YOLO.get_defaults("anchors_path")
+    )
+
+    parser.add_argument(
+        '--classes_path', type=str,
+        help='path to class definitions, default ' + YOLO.get_defaults("classes_path")
+    )
+
+    parser.add_argument(
+        '--model_image_size', type=int, nargs=2,
+        help='Fixed input height and width, default ' + str(YOLO.get_defaults("model_image_size"))
+    )
+
+    parser.add_argument(
+        '--decode', action="store_true",
+        help='Decode boxes inside the model, NMS still runs in NumPy'
+    )
+
+    parser.add_argument(
+        '--optimize', action="store_true",
+        help='Store the weights as int8'
+    )
+
+    parser.add_argument(
+        '--save', type=str, required=True,
+        help='path to save the .tflite model'
+    )
+
+    FLAGS = vars(parser.parse_args())
+    config = {key: FLAGS.get(key, YOLO.get_defaults(key)) for key in
+              ('model_path', 'anchors_path', 'classes_path',
+               'model_image_size')}
+    tflite_model = convert(config['model_path'], config['anchors_path'],
+                           config['classes_path'],
+                           config['model_image_size'],
+                           FLAGS.get('decode', False),
+                           FLAGS.get('optimize', False))
+    with open(FLAGS['save'], 'wb') as f:
+        f.write(tflite_model)
+    print('TFLite model saved to {} ({:.1f} MB)'.format(
+            FLAGS['save'], len(tflite_model) / 2 ** 20))
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,216 @@
+"""
+Export an inference-only frozen graph with a named signature
+
+The graph is frozen with the learning phase fixed to inference, then
+BatchNorm is folded into the conv weights, constant subgraphs (grid and
+anchor math of yolo_head when the input size is fixed) are folded and
+identity chains and training nodes are removed. A <name>.json signature is
+written next to the .pb, load_frozen_model reads it to find the inputs.
+
+    python -m src.export_frozen --output model_data/yolo_opt.pb --check some.jpg
+"""
+
+import argparse
+import json
+import os
+from timeit import default_timer as timer
+
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+from PIL import Image
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from src.yolo import YOLO
+
+OUTPUTS = ['boxes', 'scores', 'classes', 'num_detections']
+THRESHOLDS = ['score_threshold', 'iou_threshold', 'max_boxes']
+
+# strip_unused_nodes is left out on purpose, it rewrites the placeholder
+# dtypes to float and would break the int32 max_boxes input.
+TRANSFORMS = [
+    'fold_constants(ignore_errors=true)',
+    'fold_batch_norms',
+    'fold_old_batch_norms',
+    'remove_nodes(op=CheckNumerics)',
+    'merge_duplicate_nodes',
+    'fold_constants(ignore_errors=true)',
+    'sort_by_execution_order',
+]
+
+# Identities on these edges carry control flow frames, keep them.
+_CONTROL_FLOW_OPS = ('Switch', 'Merge', 'Enter', 'Exit', 'NextIteration',
+                     'LoopCond')
+
+
+def _node_name(tensor_name):
+    return tensor_name.lstrip('^').split(':')[0]
+
+
+def strip_identities(graph_def, protected):
+    """Rewire consumers of Identity nodes to the identity input.
+
+    Identities created by control flow, used as control dependencies or
+    named in protected (the signature) stay in place.
+    """
+    nodes = {node.name: node for node in graph_def.node}
+    control_targets = {_node_name(i) for node in graph_def.node
+                       for i in node.input if i.startswith('^')}
+    bypass = {}
+    for node in graph_def.node:
+        if node.op != 'Identity' or node.name in protected or \
+                node.name in control_targets:
+            continue
+        source = nodes.get(_node_name(node.input[0]))
+        if source is None or source.op in _CONTROL_FLOW_OPS:
+            continue
+        if any(i.startswith('^') for i in node.input):
+            continue
+        bypass[node.name] = node.input[0]
+
+    def resolve(name):
+        # Identity has a single output, name and name:0 are the same tensor.
+        while _node_name(name) in bypass:
+            name = bypass[_node_name(name)]
+        return name
+
+    stripped = tf.GraphDef()
+    stripped.versions.CopyFrom(graph_def.versions)
+    stripped.library.CopyFrom(graph_def.library)
+    for node in graph_def.node:
+        if node.name in bypass:
+            continue
+        new_node = stripped.node.add()
+        new_node.CopyFrom(node)
+        del new_node.input[:]
+        for i in node.input:
+            new_node.input.append(i if i.startswith('^') else resolve(i))
+    return stripped
+
+
+def signature(yolo):
+    """Tensor names of the inputs and outputs of the graph built by yolo."""
+    inputs = {'image': yolo.input_name.name}
+    if yolo.input_image_shape is not None:
+        inputs['image_shape'] = yolo.input_image_shape.name
+    for name in THRESHOLDS:
+        inputs[name] = name + ':0'
+    sig = {'inputs': inputs,
+           'outputs': {name: name + ':0' for name in OUTPUTS},
+           'model_image_size': list(yolo.model_image_size),
+           'preprocess': bool(yolo.preprocess)}
+    if yolo.preprocess:
+        sig['input_channels'] = yolo.input_channels
+    return sig
+
+
+def export(yolo, output_path):
+    """Freeze and optimize the graph of yolo, returns the signature."""
+    sess = yolo.sess
+    sig = signature(yolo)
+    # The channel order constant of a preprocess graph is kept as an output.
+    outputs = OUTPUTS + (['input_channels'] if yolo.preprocess else [])
+    print('Freezing session...')
+    frozen = tf.graph_util.convert_variables_to_constants(
+            sess, sess.graph_def, outputs)
+    input_nodes = [_node_name(name) for name in sig['inputs'].values()]
+
+    print('Optimizing graph...')
+    optimized = TransformGraph(frozen, input_nodes, outputs, TRANSFORMS)
+    optimized = strip_identities(optimized, set(input_nodes + outputs))
+    print('Nodes: {} frozen, {} optimized'.format(len(frozen.node),
+                                                  len(optimized.node)))
+
+    with tf.gfile.GFile(output_path, 'wb') as f:
+        f.write(optimized.SerializeToString())
+    with open(os.path.splitext(output_path)[0] + '.json', 'w') as f:
+        json.dump(sig, f, indent=2)
+    print('Graph saved to: {} ({:.1f} MB)'.format(
+            output_path, os.path.getsize(output_path) / 2 ** 20))
+    return sig
+
+
+def _latency(yolo, image, runs=10):
+    yolo.detect_image(image)
+    start = timer()
+    for _ in range(runs):
+        result = yolo.detect_image(image)
+    return result, 1000. * (timer() - start) / runs
+
+
+def check_parity(yolo_kwargs, output_path, image, atol=1e-3):
+    """Compare detections of the Keras model and the exported graph."""
+    K.clear_session()
+    K.set_learning_phase(0)
+    keras_yolo = YOLO(**yolo_kwargs)
+    expected, keras_ms = _latency(keras_yolo, image)
+    keras_yolo.close_session()
+
+    K.clear_session()
+    frozen_yolo = YOLO(**{**yolo_kwargs, 'model_path': output_path})
+    actual, frozen_ms = _latency(frozen_yolo, image)
+    frozen_yolo.close_session()
+
+    same = all(a.shape == e.shape and np.allclose(a, e, atol=atol)
+               for a, e in zip(actual, expected))
+    print('Parity {}: {} boxes from Keras, {} from the export'.format(
+            'ok' if same else 'FAILED', len(expected[0]), len(actual[0])))
+    print('Latency: {:.1f} ms Keras, {:.1f} ms export'.format(keras_ms,
+                                                              frozen_ms))
+    return same
+
+
+def _main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--model_path', type=str,
+        help='path to model weight file, default ' + YOLO.get_defaults("model_path")
+    )
+
+    parser.add_argument(
+        '--output', type=str, default='model_data/frozen_model.pb',
+        help='Path of the exported graph, default model_data/frozen_model.pb'
+    )
+
+    parser.add_argument(
+        '--rect_inference', default=False, action="store_true",
+        help='Export for letterbox-free inputs, keeps the input size dynamic'
+    )
+
+    parser.add_argument(
+        '--preprocess', default=False, action="store_true",
+        help='Export with in-graph preprocessing taking raw uint8 frames'
+    )
+
+    parser.add_argument(
+        '--input_channels', type=str, default='RGB', choices=['RGB', 'BGR'],
+        help='Channel order of raw frames with --preprocess, default RGB'
+    )
+
+    parser.add_argument(
+        '--check', type=str, default=None,
+        help='Image to compare the export against the Keras model on'
+    )
+
+    FLAGS = parser.parse_args()
+    yolo_kwargs = {'rect_inference': FLAGS.rect_inference,
+                   'preprocess': FLAGS.preprocess,
+                   'input_channels': FLAGS.input_channels}
+    if FLAGS.model_path:
+        yolo_kwargs['model_path'] = FLAGS.model_path
+
+    # Inference-only graph, no learning phase switch to freeze in.
+    K.clear_session()
+    K.set_learning_phase(0)
+    # A fixed input shape lets the grid math of yolo_head fold to constants.
+    static = not FLAGS.rect_inference and not FLAGS.preprocess
+    yolo = YOLO(static_input=static, **yolo_kwargs)
+    export(yolo, FLAGS.output)
+    yolo.close_session()
+
+    if FLAGS.check:
+        check_parity(yolo_kwargs, FLAGS.output, Image.open(FLAGS.check))
+
+
+if __name__ == '__main__':
+    _main()
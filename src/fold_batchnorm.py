@@ -0,0 +1,67 @@
+"""
+Fold BatchNormalization into the convolutions of a trained YOLO .h5
+
+The result runs one biased conv per Darknet block instead of conv then
+BatchNormalization. It is checked against the original before saving:
+
+    python -m src.fold_batchnorm model_data/yolo.h5 model_data/yolo_folded.h5
+
+The folded .h5 is a full model and loads in YOLO like any other, or pass
+--fold_batchnorm to yolo_video.py to fold at load time instead.
+"""
+
+import argparse
+
+from keras import backend as K
+
+from src.train import get_classes, get_anchors
+from src.yolo3.model import load_yolo_body, fold_batch_norm, verify_fold, \
+    model_latency
+
+
+def _main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'model_path', type=str,
+        help='Trained yolo_body or tiny_yolo_body .h5'
+    )
+
+    parser.add_argument(
+        'output_path', type=str,
+        help='Where to save the folded model'
+    )
+
+    parser.add_argument(
+        '--anchors_path', type=str, default='model_data/yolo_anchors.txt',
+        help='Anchors used when the .h5 only holds weights'
+    )
+
+    parser.add_argument(
+        '--classes_path', type=str, default='model_data/AR10_classes.txt',
+        help='Classes used when the .h5 only holds weights'
+    )
+
+    parser.add_argument(
+        '--input_size', type=int, default=416,
+        help='Input size for the numerical check, default 416'
+    )
+
+    FLAGS = parser.parse_args()
+    K.set_learning_phase(0)
+    model = load_yolo_body(FLAGS.model_path,
+                           len(get_anchors(FLAGS.anchors_path)),
+                           len(get_classes(FLAGS.classes_path)))
+    folded = fold_batch_norm(model)
+    input_shape = (FLAGS.input_size, FLAGS.input_size)
+    error = verify_fold(model, folded, input_shape)
+    print('Layers: {} -> {}, max abs difference {:.2e}'.format(
+            len(model.layers), len(folded.layers), error))
+    print('Latency: {:.1f} ms -> {:.1f} ms'.format(
+            model_latency(model, input_shape),
+            model_latency(folded, input_shape)))
+    folded.save(FLAGS.output_path)
+    print('Folded model saved to {}'.format(FLAGS.output_path))
+
+
+if __name__ == '__main__':
+    _main()
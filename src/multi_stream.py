@@ -0,0 +1,185 @@
+"""
+Serve many video streams with one YOLO model by batching their frames
+"""
+
+import argparse
+import time
+from timeit import default_timer as timer
+
+from PIL import Image
+
+from src.yolo import YOLO
+from src.VideoCaptureAsync import VideoCaptureAsync
+
+
+class StreamStats(object):
+    """Processed frames and capture-to-result latency of one stream."""
+
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.latency = 0.
+        self.start_time = timer()
+
+    def add(self, latency):
+        self.frames += 1
+        self.latency += latency
+
+    def __str__(self):
+        elapsed = timer() - self.start_time
+        return '{}: {:.1f} FPS, {:.0f} ms mean latency'.format(
+                self.name, self.frames / elapsed if elapsed > 0 else 0.,
+                1000. * self.latency / self.frames if self.frames else 0.)
+
+
+def print_sink(stream, seq, frame, detections):
+    boxes, scores, classes = detections
+    print('stream {} frame {}: {} boxes'.format(stream, seq, len(boxes)))
+
+
+class MultiStreamRunner(object):
+    """Feed the newest frame of every stream through one batched session call.
+
+    Each source gets its own VideoCaptureAsync thread. Every step borrows at
+    most one new frame per stream, runs them as one batch and hands each
+    result to that stream's sink as sink(stream, seq, frame, detections).
+    Streams are visited round robin from a rotating start, so with
+    max_batch below the number of streams every stream is still served in
+    turn.
+    """
+
+    def __init__(self, yolo, sources, sinks=None, max_batch=None,
+                 policy='drop_oldest', report_every=10.):
+        self.yolo = yolo
+        self.captures = [VideoCaptureAsync(source, buffer_size=2,
+                                           policy=policy)
+                         for source in sources]
+        self.sinks = sinks if sinks is not None else \
+            [print_sink] * len(sources)
+        assert len(self.sinks) == len(self.captures), \
+            'Need one sink per stream'
+        self.max_batch = max_batch or len(sources)
+        # Live streams jump to their newest frame, files go frame by frame.
+        self.latest = policy == 'drop_oldest'
+        self.report_every = report_every
+        self.stats = [StreamStats(str(source)) for source in sources]
+        self.next_stream = 0
+
+    def _detect(self, frames):
+        # OpenCV decodes to BGR. A BGR preprocess graph swaps the channels
+        # itself, everything else needs RGB.
+        if self.yolo.preprocess and self.yolo.input_channels == 'BGR':
+            return self.yolo.detect_frames(frames)
+        frames = [frame[..., ::-1] for frame in frames]
+        if self.yolo.preprocess:
+            return self.yolo.detect_frames(frames)
+        return self.yolo.detect_images([Image.fromarray(frame)
+                                        for frame in frames])
+
+    def step(self):
+        """Run one batch, return the number of frames processed."""
+        streams, seqs, frames = [], [], []
+        num_streams = len(self.captures)
+        for k in range(num_streams):
+            if len(frames) >= self.max_batch:
+                break
+            i = (self.next_stream + k) % num_streams
+            seq, frame = self.captures[i].borrow(timeout=0,
+                                                   latest=self.latest)
+            if seq is not None:
+                streams.append(i)
+                seqs.append(seq)
+                frames.append(frame)
+        self.next_stream = (self.next_stream + max(1, len(frames))) % \
+            num_streams
+        if not frames:
+            return 0
+
+        results = self._detect(frames)
+        done = timer()
+        for i, seq, frame, detections in zip(streams, seqs, frames, results):
+            self.stats[i].add(done - self.captures[i].frame_time(seq))
+            self.sinks[i](i, seq, frame, detections)
+            self.captures[i].release(seq)
+        return len(frames)
+
+    def run(self, idle_wait=0.005):
+        for capture in self.captures:
+            capture.start()
+        last_report = timer()
+        try:
+            while not all(capture.finished for capture in self.captures):
+                if self.step() == 0:
+                    time.sleep(idle_wait)
+                if timer() - last_report > self.report_every:
+                    last_report = timer()
+                    self.report()
+        finally:
+            for capture in self.captures:
+                capture.stop()
+        self.report()
+
+    def report(self):
+        for stats in self.stats:
+            print(stats)
+
+
+def _main():
+    # class YOLO defines the default value, so suppress any default here
+    parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS)
+    '''
+    Command line options
+    '''
+    parser.add_argument(
+        '--model_path', type=str,
+        help='path to model weight file, default ' + YOLO.get_defaults("model_path")
+    )
+
+    parser.add_argument(
+        '--anchors_path', type=str,
+        help='path to anchor definitions, default ' + YOLO.get_defaults("anchors_path")
+    )
+
+    parser.add_argument(
+        '--classes_path', type=str,
+        help='path to class definitions, default ' + YOLO.get_defaults("classes_path")
+    )
+
+    parser.add_argument(
+        '--preprocess', action="store_true",
+        help='Letterbox and normalize raw uint8 frames inside the graph'
+    )
+
+    parser.add_argument(
+        '--input_channels', type=str, choices=['RGB', 'BGR'],
+        help='Channel order the --preprocess graph expects, BGR takes the decoded frames as they are, default ' + YOLO.get_defaults("input_channels")
+    )
+
+    parser.add_argument(
+        '--max_batch', type=int, default=None,
+        help='Maximum number of streams per session call, default all streams'
+    )
+
+    parser.add_argument(
+        '--policy', type=str, default='drop_oldest',
+        choices=['drop_oldest', 'block'],
+        help='drop_oldest for live streams, block to process every frame of files'
+    )
+
+    parser.add_argument(
+        "--inputs", nargs='+', type=str, required=True,
+        help="Video files or stream URLs"
+    )
+
+    FLAGS = vars(parser.parse_args())
+    sources = FLAGS.pop('inputs')
+    max_batch = FLAGS.pop('max_batch')
+    policy = FLAGS.pop('policy')
+
+    yolo = YOLO(**FLAGS)
+    MultiStreamRunner(yolo, sources, max_batch=max_batch, policy=policy).run()
+    yolo.close_session()
+
+
+if __name__ == '__main__':
+    _main()
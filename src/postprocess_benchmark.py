@@ -0,0 +1,147 @@
+"""
+Check the NumPy post-processing against the graph path and time both
+
+Runs yolo3/model.py yolo_eval_batch and yolo3/postprocess.py yolo_eval_batch
+on the same head outputs, reports mismatching images and the per frame
+post-processing time. Head outputs come from an .npz cached with
+np.savez(path, *yolo_model.predict(images)) or are random logits.
+
+    python -m src.postprocess_benchmark --batch_size 4 --score 0.05
+"""
+
+import argparse
+from timeit import default_timer as timer
+
+import numpy as np
+from keras import backend as K
+
+from src.train import get_classes, get_anchors
+from src.yolo import YOLO
+from src.yolo3 import model, postprocess
+
+
+def random_outputs(batch_size, num_anchors, num_classes, input_size=416,
+                   objectness_bias=-4., seed=0):
+    """Head outputs with mostly low objectness, like a sparse scene."""
+    rng = np.random.RandomState(seed)
+    num_layers = 3 if num_anchors == 9 else 2
+    outputs = []
+    for l in range(num_layers):
+        grid = input_size // (32 >> l)
+        feats = rng.randn(batch_size, grid, grid, num_anchors // num_layers,
+                          num_classes + 5).astype('float32')
+        feats[..., 4] += objectness_bias
+        outputs.append(feats.reshape(batch_size, grid, grid, -1))
+    return outputs
+
+
+def _time(fn, runs):
+    fn()
+    start = timer()
+    for _ in range(runs):
+        result = fn()
+    return result, (timer() - start) / runs
+
+
+def compare(yolo_outputs, anchors, num_classes, image_shapes, runs=20,
+            **eval_kwargs):
+    """Mismatching images and seconds per frame of the graph and NumPy."""
+    batch_size = len(image_shapes)
+    heads = [K.placeholder(shape=(None, None, None, feats.shape[-1]))
+             for feats in yolo_outputs]
+    shapes = K.placeholder(shape=(None, 2))
+    graph_outputs = model.yolo_eval_batch(heads, anchors, num_classes,
+                                          shapes, **eval_kwargs)
+    sess = K.get_session()
+    feed_dict = {shapes: image_shapes, **dict(zip(heads, yolo_outputs))}
+    (boxes, scores, classes, num), graph_time = _time(
+            lambda: sess.run(graph_outputs, feed_dict), runs)
+    expected = [(boxes[i, :n], scores[i, :n], classes[i, :n])
+                for i, n in enumerate(num)]
+
+    actual, numpy_time = _time(lambda: postprocess.yolo_eval_batch(
+            yolo_outputs, anchors, num_classes, image_shapes, **eval_kwargs),
+                               runs)
+
+    mismatches = [i for i, (a, e) in enumerate(zip(actual, expected))
+                  if len(a[0]) != len(e[0]) or
+                  not np.allclose(a[0], e[0], atol=1e-2) or
+                  not np.allclose(a[1], e[1], atol=1e-5) or
+                  not np.array_equal(a[2], e[2])]
+    return mismatches, graph_time / batch_size, numpy_time / batch_size
+
+
+def _main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--outputs', type=str, default=None,
+        help='.npz of cached head outputs, random logits when not given'
+    )
+
+    parser.add_argument(
+        '--batch_size', type=int, default=4,
+        help='Images of random head outputs, default 4'
+    )
+
+    parser.add_argument(
+        '--anchors_path', type=str, default=YOLO.get_defaults('anchors_path'),
+        help='path to anchor definitions, default ' + YOLO.get_defaults("anchors_path")
+    )
+
+    parser.add_argument(
+        '--classes_path', type=str, default=YOLO.get_defaults('classes_path'),
+        help='path to class definitions, default ' + YOLO.get_defaults("classes_path")
+    )
+
+    parser.add_argument(
+        '--score', type=float, default=YOLO.get_defaults('score'),
+        help='Score threshold, default ' + str(YOLO.get_defaults("score"))
+    )
+
+    parser.add_argument(
+        '--iou', type=float, default=YOLO.get_defaults('iou'),
+        help='IOU threshold, default ' + str(YOLO.get_defaults("iou"))
+    )
+
+    parser.add_argument(
+        '--max_boxes', type=int, default=YOLO.get_defaults('max_boxes'),
+        help='Box cap, default ' + str(YOLO.get_defaults("max_boxes"))
+    )
+
+    parser.add_argument(
+        '--runs', type=int, default=20,
+        help='Timed runs, default 20'
+    )
+
+    FLAGS = parser.parse_args()
+    anchors = get_anchors(FLAGS.anchors_path)
+    num_classes = len(get_classes(FLAGS.classes_path))
+    if FLAGS.outputs:
+        cached = np.load(FLAGS.outputs)
+        yolo_outputs = [cached[name] for name in sorted(cached.files)]
+    else:
+        yolo_outputs = random_outputs(FLAGS.batch_size, len(anchors),
+                                      num_classes)
+    # Random but fixed original image sizes, to exercise the letterbox math.
+    image_shapes = np.array([(480, 640), (720, 1280), (1080, 1920),
+                             (416, 416)] * len(yolo_outputs[0]),
+                            dtype='float32')[:len(yolo_outputs[0])]
+
+    for nms_mode in ('per_class', 'class_aware'):
+        mismatches, graph_time, numpy_time = compare(
+                yolo_outputs, anchors, num_classes, image_shapes, FLAGS.runs,
+                max_boxes=FLAGS.max_boxes, score_threshold=FLAGS.score,
+                iou_threshold=FLAGS.iou, nms_mode=nms_mode)
+        print('{}: {} of {} images differ, graph {:.2f} ms, NumPy {:.2f} ms '
+              'per frame'.format(nms_mode, len(mismatches), len(image_shapes),
+                                 1000 * graph_time, 1000 * numpy_time))
+        _, fast_time = _time(lambda: postprocess.yolo_eval_batch(
+                yolo_outputs, anchors, num_classes, image_shapes,
+                FLAGS.max_boxes, FLAGS.score, FLAGS.iou, nms_mode,
+                fast_nms=True), FLAGS.runs)
+        print('{} with fast NMS: {:.2f} ms per frame'.format(
+                nms_mode, 1000 * fast_time / len(image_shapes)))
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,206 @@
+"""
+Multi-process CPU inference: K workers, each with its own session and cores
+
+Run as a script to benchmark throughput for several worker counts:
+
+    python -m src.process_pool --image some.jpg --workers 1 2 4 8
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import queue
+import traceback
+from timeit import default_timer as timer
+
+import numpy as np
+
+
+def _worker(cores, yolo_kwargs, buffers, tasks, results):
+    # Results are (job, slot, detections, error), errors go back as the
+    # formatted traceback so the parent does not wait forever.
+    try:
+        # Pin first, then size the TF thread pools to the cores we own.
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+        from PIL import Image
+        from src.yolo import YOLO
+
+        yolo = YOLO(**{'intra_op_threads': len(cores), 'inter_op_threads': 1,
+                       **yolo_kwargs})
+    except Exception:
+        results.put((None, None, None, traceback.format_exc()))
+        return
+    results.put((None, None, os.getpid(), None))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        job, slot, shape = task
+        try:
+            frame = np.frombuffer(buffers[slot], dtype=np.uint8,
+                                  count=int(np.prod(shape))).reshape(shape)
+            if yolo.preprocess:
+                detections = yolo.detect_frames([frame])[0]
+            else:
+                detections = yolo.detect_image(Image.fromarray(frame))
+        except Exception:
+            results.put((job, slot, None, traceback.format_exc()))
+        else:
+            results.put((job, slot, detections, None))
+    yolo.close_session()
+
+
+class DetectionPool(object):
+    """Pool of worker processes that each load the model once.
+
+    The cores are split evenly between workers. Each worker is pinned to its
+    share and runs a session with matching intra-op threads. Frames travel
+    through preallocated shared memory slots; only (job, slot, shape) goes
+    through the task queue that all workers pull from. max_frame_shape is the
+    largest (h, w, 3) frame that will be sent.
+    """
+
+    def __init__(self, num_workers, max_frame_shape, yolo_kwargs=None,
+                 cores=None, slots_per_worker=2):
+        cores = cores if cores is not None else range(os.cpu_count())
+        self.shares = [list(map(int, share)) for share in
+                       np.array_split(list(cores), num_workers)]
+        # Spawn, a forked TF runtime is not safe to use.
+        ctx = mp.get_context('spawn')
+        self.frame_size = int(np.prod(max_frame_shape))
+        self.buffers = [ctx.RawArray('B', self.frame_size)
+                        for _ in range(num_workers * slots_per_worker)]
+        self.free_slots = list(range(len(self.buffers)))
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.workers = [ctx.Process(target=_worker,
+                                    args=(share, yolo_kwargs or {},
+                                          self.buffers, self.tasks,
+                                          self.results),
+                                    daemon=True)
+                        for share in self.shares]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        # Wait until every worker has loaded its model.
+        for _ in self.workers:
+            self._result()
+        return self
+
+    def _result(self, poll=1.):
+        # Poll so a worker that died without reporting is noticed.
+        while True:
+            try:
+                job, slot, detections, error = self.results.get(timeout=poll)
+                break
+            except queue.Empty:
+                dead = [w.pid for w in self.workers if not w.is_alive()]
+                if dead:
+                    raise RuntimeError(
+                            'Worker {} exited unexpectedly'.format(dead))
+        if slot is not None:
+            self.free_slots.append(slot)
+        if error is not None:
+            raise RuntimeError('Worker failed:\n' + error)
+        return job, detections
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def _send(self, job, frame):
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        # Check before taking a slot, a failed copy would leak it.
+        if frame.nbytes > self.frame_size:
+            raise ValueError('Frame of shape {} is larger than the {} bytes '
+                             'of max_frame_shape'.format(frame.shape,
+                                                          self.frame_size))
+        slot = self.free_slots.pop()
+        view = np.frombuffer(self.buffers[slot], dtype=np.uint8,
+                             count=frame.size)
+        view[:] = frame.reshape(-1)
+        self.tasks.put((job, slot, frame.shape))
+
+    def imap(self, frames):
+        """Yield (boxes, scores, classes) for every frame, in order."""
+        frames = iter(frames)
+        finished = {}
+        sent = 0
+        received = 0
+        exhausted = False
+        while True:
+            while not exhausted and self.free_slots:
+                try:
+                    self._send(sent, next(frames))
+                    sent += 1
+                except StopIteration:
+                    exhausted = True
+            if exhausted and received == sent:
+                return
+            job, detections = self._result()
+            finished[job] = detections
+            while received in finished:
+                yield finished.pop(received)
+                received += 1
+
+    def detect_frames(self, frames):
+        return list(self.imap(frames))
+
+
+def benchmark(frames, worker_counts, yolo_kwargs=None, warmup=4):
+    """Frames per second of a DetectionPool for every worker count."""
+    max_shape = tuple(np.max([frame.shape for frame in frames], axis=0))
+    report = {}
+    for num_workers in worker_counts:
+        pool = DetectionPool(num_workers, max_shape, yolo_kwargs).start()
+        try:
+            pool.detect_frames(frames[:warmup * num_workers])
+            start = timer()
+            pool.detect_frames(frames)
+            elapsed = timer() - start
+        finally:
+            pool.close()
+        report[num_workers] = len(frames) / elapsed
+        print('{} workers ({} cores each): {:.2f} FPS'.format(
+                num_workers, len(pool.shares[0]), report[num_workers]))
+    return report
+
+
+def _main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--image', type=str, required=True,
+        help='Image to run repeatedly'
+    )
+
+    parser.add_argument(
+        '--frames', type=int, default=64,
+        help='Number of frames per measurement, default 64'
+    )
+
+    parser.add_argument(
+        '--workers', type=int, nargs='+', default=[1, 2, 4],
+        help='Worker counts to compare, default 1 2 4'
+    )
+
+    parser.add_argument(
+        '--model_path', type=str,
+        help='path to model weight file, default from YOLO'
+    )
+
+    FLAGS = parser.parse_args()
+    from PIL import Image
+    frame = np.array(Image.open(FLAGS.image).convert('RGB'))
+    yolo_kwargs = {'model_path': FLAGS.model_path} if FLAGS.model_path else {}
+    report = benchmark([frame] * FLAGS.frames, FLAGS.workers, yolo_kwargs)
+    best = max(report, key=report.get)
+    print('Best: {} workers at {:.2f} FPS'.format(best, report[best]))
+
+
+if __name__ == '__main__':
+    _main()
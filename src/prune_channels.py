@@ -0,0 +1,135 @@
+"""
+Structured channel pruning of a trained YOLO model, then fine-tuning
+
+For every ratio the backbone and head filters with the smallest
+BatchNormalization gammas are removed (see yolo3/model.py prune_channels),
+the slimmer model is fine-tuned with the train.py loss and data pipeline
+and saved as <output_dir>/pruned_<ratio>.h5. FLOPs, CPU latency and
+val loss are reported for the original and every pruned model:
+
+    python -m src.prune_channels model_data/yolo.h5 train.txt \
+        --ratios 0.25 0.5 --epochs 10
+"""
+
+import argparse
+import os
+
+import numpy as np
+from keras import backend as K
+from keras.optimizers import Adam
+
+from src.train import get_classes, get_anchors, attach_loss, y_true_inputs, \
+    data_generator_wrapper
+from src.yolo3.model import load_yolo_body, prune_channels, count_flops, \
+    model_latency
+
+
+def fine_tune(model_body, train_lines, val_lines, input_shape, anchors,
+              num_classes, epochs, batch_size=8, lr=1e-4):
+    """Fine-tune model_body with yolo_loss, returns the val loss after."""
+    model = attach_loss(model_body, y_true_inputs(input_shape, anchors,
+                                                  num_classes),
+                        anchors, num_classes)
+    model.compile(optimizer=Adam(lr=lr),
+                  loss={'yolo_loss': lambda y_true, y_pred: y_pred})
+    if epochs > 0:
+        model.fit_generator(
+                data_generator_wrapper(train_lines, batch_size, input_shape,
+                                       anchors, num_classes),
+                steps_per_epoch=max(1, len(train_lines) // batch_size),
+                epochs=epochs)
+    return model.evaluate_generator(
+            data_generator_wrapper(val_lines, batch_size, input_shape,
+                                   anchors, num_classes),
+            steps=max(1, len(val_lines) // batch_size))
+
+
+def _main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'model_path', type=str,
+        help='Trained yolo_body or tiny_yolo_body .h5'
+    )
+
+    parser.add_argument(
+        'annotation_path', type=str,
+        help='Annotation file in the train.py format'
+    )
+
+    parser.add_argument(
+        '--ratios', type=float, nargs='+', default=[0.25, 0.5],
+        help='Fractions of filters to remove, default 0.25 0.5'
+    )
+
+    parser.add_argument(
+        '--epochs', type=int, default=10,
+        help='Fine-tuning epochs per ratio, default 10'
+    )
+
+    parser.add_argument(
+        '--batch_size', type=int, default=8,
+        help='Fine-tuning batch size, default 8'
+    )
+
+    parser.add_argument(
+        '--val_split', type=float, default=0.1,
+        help='Share of annotations held out for val loss, default 0.1'
+    )
+
+    parser.add_argument(
+        '--anchors_path', type=str, default='model_data/yolo_anchors.txt',
+        help='path to anchor definitions, default model_data/yolo_anchors.txt'
+    )
+
+    parser.add_argument(
+        '--classes_path', type=str, default='model_data/AR10_classes.txt',
+        help='path to class definitions, default model_data/AR10_classes.txt'
+    )
+
+    parser.add_argument(
+        '--output_dir', type=str, default='model_data',
+        help='Where to save the pruned models, default model_data'
+    )
+
+    FLAGS = parser.parse_args()
+    anchors = get_anchors(FLAGS.anchors_path)
+    num_classes = len(get_classes(FLAGS.classes_path))
+    input_shape = (416, 416)  # multiple of 32, hw
+
+    with open(FLAGS.annotation_path) as f:
+        lines = f.readlines()
+    # Same split as train.py.
+    np.random.seed(10101)
+    np.random.shuffle(lines)
+    np.random.seed(None)
+    num_val = int(len(lines) * FLAGS.val_split)
+    train_lines, val_lines = lines[num_val:], lines[:num_val]
+
+    report = []
+    for ratio in [0.] + FLAGS.ratios:
+        K.clear_session()
+        model_body = load_yolo_body(FLAGS.model_path, len(anchors),
+                                    num_classes)
+        epochs = 0
+        if ratio > 0:
+            model_body, kept = prune_channels(model_body, ratio)
+            print('Ratio {}: {} filter groups pruned'.format(ratio, len(kept)))
+            epochs = FLAGS.epochs
+        val_loss = fine_tune(model_body, train_lines, val_lines, input_shape,
+                             anchors, num_classes, epochs, FLAGS.batch_size)
+        if ratio > 0:
+            model_body.save(os.path.join(FLAGS.output_dir,
+                                         'pruned_{}.h5'.format(ratio)))
+        report.append((ratio, count_flops(model_body, input_shape),
+                       model_latency(model_body, input_shape), val_loss))
+
+    base_flops, base_latency = report[0][1:3]
+    for ratio, flops, latency, val_loss in report:
+        print('ratio {:.2f}: {:.1f} GFLOPs ({:.2f}x), {:.1f} ms ({:.2f}x), '
+              'val loss {:.3f}'.format(ratio, flops / 1e9, base_flops / flops,
+                                       latency, base_latency / latency,
+                                       val_loss))
+
+
+if __name__ == '__main__':
+    _main()
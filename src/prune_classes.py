@@ -0,0 +1,90 @@
+"""
+Cut the detection heads of a trained YOLO .h5 down to a subset of classes
+
+    python -m src.prune_classes model_data/yolo.h5 model_data/yolo_person.h5 \
+        --classes_path model_data/coco_classes.txt --keep person
+
+Writes the pruned model and its classes file (<output>_classes.txt). Load
+both in YOLO to decode and run NMS on the kept classes only; detections
+of those classes are the same as with the full model.
+"""
+
+import argparse
+import os
+
+import numpy as np
+from keras import backend as K
+
+from src.train import get_classes, get_anchors
+from src.yolo import YOLO
+from src.yolo3.model import load_yolo_body, prune_classes
+
+
+def check_pruned(model, pruned, num_classes, keep, input_size=416, atol=1e-5):
+    """Max difference between the pruned heads and the same channels of the
+    full heads on a random batch."""
+    x = np.random.rand(1, input_size, input_size, 3).astype('float32')
+    error = 0.
+    for full, small in zip(model.predict(x), pruned.predict(x)):
+        num_anchors = full.shape[-1] // (num_classes + 5)
+        full = full.reshape(full.shape[:3] + (num_anchors, num_classes + 5))
+        full = np.concatenate([full[..., :5], full[..., 5 + np.array(keep)]],
+                              axis=-1)
+        error = max(error, np.abs(full.reshape(small.shape) - small).max())
+    assert error <= atol, 'Pruned heads differ by {}'.format(error)
+    return error
+
+
+def _main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'model_path', type=str,
+        help='Trained yolo_body or tiny_yolo_body .h5'
+    )
+
+    parser.add_argument(
+        'output_path', type=str,
+        help='Where to save the pruned model'
+    )
+
+    parser.add_argument(
+        '--keep', type=str, nargs='+', required=True,
+        help='Names of the classes to keep, in the new class order'
+    )
+
+    parser.add_argument(
+        '--anchors_path', type=str, default=YOLO.get_defaults('anchors_path'),
+        help='path to anchor definitions, default ' + YOLO.get_defaults("anchors_path")
+    )
+
+    parser.add_argument(
+        '--classes_path', type=str, default=YOLO.get_defaults('classes_path'),
+        help='path to class definitions, default ' + YOLO.get_defaults("classes_path")
+    )
+
+    FLAGS = parser.parse_args()
+    class_names = get_classes(FLAGS.classes_path)
+    missing = [name for name in FLAGS.keep if name not in class_names]
+    assert not missing, 'Unknown classes: {}'.format(', '.join(missing))
+    keep = [class_names.index(name) for name in FLAGS.keep]
+
+    K.set_learning_phase(0)
+    model = load_yolo_body(FLAGS.model_path,
+                           len(get_anchors(FLAGS.anchors_path)),
+                           len(class_names))
+    pruned = prune_classes(model, len(class_names), keep)
+    error = check_pruned(model, pruned, len(class_names), keep)
+    print('Head channels {} -> {}, max abs difference {:.2e}'.format(
+            [int(o.shape[-1]) for o in model.outputs],
+            [int(o.shape[-1]) for o in pruned.outputs], error))
+
+    pruned.save(FLAGS.output_path)
+    classes_path = os.path.splitext(FLAGS.output_path)[0] + '_classes.txt'
+    with open(classes_path, 'w') as f:
+        f.write('\n'.join(FLAGS.keep) + '\n')
+    print('Pruned model saved to {}, classes to {}'.format(
+            FLAGS.output_path, classes_path))
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,144 @@
+"""
+Post-training float16 and int8 weight quantization with an accuracy report
+
+    python -m src.quantize model_data/yolo.h5 --annotation_path train.txt \
+        --validation_path val.txt --output_dir model_data
+
+Writes <name>_float16.npz and <name>_int8.npz, which YOLO loads like a .h5,
+and reports file size, load time, CPU latency and mAP against float32.
+"""
+
+import argparse
+import os
+from timeit import default_timer as timer
+
+import numpy as np
+from keras import backend as K
+from PIL import Image
+
+from src.train import get_classes, get_anchors
+from src.yolo import YOLO
+from src.yolo3.model import load_yolo_body, model_latency
+from src.yolo3.quantization import MODES, calibrate, save_quantized, \
+    load_quantized
+from src.yolo3.utils import letterbox_image
+
+
+def calibration_images(annotation_path, count, input_size, seed=10101):
+    """A fixed random sample of annotated images, letterboxed to input_size."""
+    with open(annotation_path) as f:
+        lines = [line.split()[0] for line in f if line.strip()]
+    rng = np.random.RandomState(seed)
+    paths = rng.choice(lines, min(count, len(lines)), replace=False)
+    return np.stack([np.array(letterbox_image(
+            Image.open(path).convert('RGB'), (input_size, input_size)),
+            dtype='float32') / 255. for path in paths])
+
+
+def _load(path, num_anchors, num_classes):
+    K.clear_session()
+    start = timer()
+    if path.endswith('.npz'):
+        model = load_quantized(path)
+    else:
+        model = load_yolo_body(path, num_anchors, num_classes)
+    return model, timer() - start
+
+
+def report(paths, anchors_path, classes_path, validation_path=None,
+           input_size=416):
+    """Size, load time, latency and mAP of every model in paths."""
+    num_anchors = len(get_anchors(anchors_path))
+    num_classes = len(get_classes(classes_path))
+    rows = []
+    for path in paths:
+        model, load_time = _load(path, num_anchors, num_classes)
+        row = {'path': path, 'size': os.path.getsize(path) / 2 ** 20,
+               'load': load_time,
+               'latency': model_latency(model, (input_size, input_size))}
+        if validation_path:
+            K.clear_session()
+            yolo = YOLO(model_path=path, anchors_path=anchors_path,
+                        classes_path=classes_path)
+            row['mAP'] = yolo.evaluate(validation_path)[0]
+            yolo.close_session()
+        rows.append(row)
+
+    baseline = rows[0]
+    for row in rows:
+        line = '{path}: {size:.1f} MB, load {load:.2f} s, ' \
+               'latency {latency:.1f} ms'.format(**row)
+        if 'mAP' in row:
+            line += ', mAP {:.4f} ({:+.4f})'.format(
+                    row['mAP'], row['mAP'] - baseline['mAP'])
+        print(line)
+    return rows
+
+
+def _main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'model_path', type=str,
+        help='Trained float32 yolo_body or tiny_yolo_body .h5'
+    )
+
+    parser.add_argument(
+        '--annotation_path', type=str, required=True,
+        help='Annotation file to draw calibration images from'
+    )
+
+    parser.add_argument(
+        '--calibration_size', type=int, default=16,
+        help='Number of calibration images, default 16'
+    )
+
+    parser.add_argument(
+        '--validation_path', type=str, default=None,
+        help='Annotation file to compare mAP on, skipped when not given'
+    )
+
+    parser.add_argument(
+        '--output_dir', type=str, default='model_data',
+        help='Where to write the quantized models, default model_data'
+    )
+
+    parser.add_argument(
+        '--anchors_path', type=str, default=YOLO.get_defaults('anchors_path'),
+        help='path to anchor definitions, default ' + YOLO.get_defaults("anchors_path")
+    )
+
+    parser.add_argument(
+        '--classes_path', type=str, default=YOLO.get_defaults('classes_path'),
+        help='path to class definitions, default ' + YOLO.get_defaults("classes_path")
+    )
+
+    parser.add_argument(
+        '--input_size', type=int, default=416,
+        help='Input size for calibration and latency, default 416'
+    )
+
+    FLAGS = parser.parse_args()
+    K.set_learning_phase(0)
+    model = load_yolo_body(FLAGS.model_path,
+                           len(get_anchors(FLAGS.anchors_path)),
+                           len(get_classes(FLAGS.classes_path)))
+    images = calibration_images(FLAGS.annotation_path,
+                                FLAGS.calibration_size, FLAGS.input_size)
+    percentile, errors = calibrate(model, images)
+    for p, error in sorted(errors.items(), reverse=True):
+        print('int8 clipping at percentile {}: relative error {:.2e}'.format(
+                p, error))
+
+    name = os.path.splitext(os.path.basename(FLAGS.model_path))[0]
+    paths = [FLAGS.model_path]
+    for mode in MODES:
+        path = os.path.join(FLAGS.output_dir, '{}_{}.npz'.format(name, mode))
+        save_quantized(model, path, mode, percentile)
+        paths.append(path)
+
+    report(paths, FLAGS.anchors_path, FLAGS.classes_path,
+           FLAGS.validation_path, FLAGS.input_size)
+
+
+if __name__ == '__main__':
+    _main()
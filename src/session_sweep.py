@@ -0,0 +1,97 @@
+"""
+Measure detect_image latency for a grid of TF session configurations
+"""
+
+import argparse
+import itertools
+from timeit import default_timer as timer
+
+import numpy as np
+from keras import backend as K
+from PIL import Image
+
+from src.yolo import YOLO
+
+
+def measure(yolo, image, runs=20, warmup=3):
+    """Latencies in ms of detect_image, after warmup runs."""
+    for _ in range(warmup):
+        yolo.detect_image(image)
+    latencies = []
+    for _ in range(runs):
+        start = timer()
+        yolo.detect_image(image)
+        latencies.append(1000. * (timer() - start))
+    return np.array(latencies)
+
+
+def sweep(image, intra_op_threads, inter_op_threads, graph_optimization,
+          xla_jit, runs=20, **yolo_kwargs):
+    results = []
+    for intra, inter, optimization, xla in itertools.product(
+            intra_op_threads, inter_op_threads, graph_optimization, xla_jit):
+        K.clear_session()
+        config = {'intra_op_threads': intra, 'inter_op_threads': inter,
+                  'graph_optimization': optimization, 'xla_jit': xla}
+        yolo = YOLO(**config, **yolo_kwargs)
+        latencies = measure(yolo, image, runs)
+        yolo.close_session()
+        results.append((config, latencies))
+        print('intra={intra_op_threads} inter={inter_op_threads} '
+              'opt={graph_optimization} xla={xla_jit}: '.format(**config) +
+              'mean {:.1f} ms, p50 {:.1f} ms, p90 {:.1f} ms'.format(
+                      latencies.mean(), np.percentile(latencies, 50),
+                      np.percentile(latencies, 90)))
+
+    best_config, best = min(results, key=lambda r: np.median(r[1]))
+    print('Best: {} at p50 {:.1f} ms'.format(best_config, np.median(best)))
+    return results
+
+
+def _main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--image', type=str, required=True,
+        help='Image to run detection on'
+    )
+
+    parser.add_argument(
+        '--model_path', type=str,
+        help='path to model weight file, default ' + YOLO.get_defaults("model_path")
+    )
+
+    parser.add_argument(
+        '--runs', type=int, default=20,
+        help='Timed runs per configuration, default 20'
+    )
+
+    parser.add_argument(
+        '--intra_op_threads', type=int, nargs='+', default=[0],
+        help='Values to try, default 0'
+    )
+
+    parser.add_argument(
+        '--inter_op_threads', type=int, nargs='+', default=[0],
+        help='Values to try, default 0'
+    )
+
+    parser.add_argument(
+        '--graph_optimization', type=str, nargs='+', default=['default'],
+        choices=['default', 'aggressive', 'off'],
+        help='Values to try, default default'
+    )
+
+    parser.add_argument(
+        '--xla_jit', type=int, nargs='+', default=[0], choices=[0, 1],
+        help='Values to try, default 0'
+    )
+
+    FLAGS = parser.parse_args()
+    yolo_kwargs = {'model_path': FLAGS.model_path} if FLAGS.model_path else {}
+    sweep(Image.open(FLAGS.image), FLAGS.intra_op_threads,
+          FLAGS.inter_op_threads, FLAGS.graph_optimization,
+          [bool(x) for x in FLAGS.xla_jit], FLAGS.runs, **yolo_kwargs)
+
+
+if __name__ == '__main__':
+    _main()
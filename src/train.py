@@ -2,6 +2,8 @@
 Retrain the YOLO model for your own dataset.
 """
 
+import os
+
 import numpy as np
 import keras.backend as K
 from keras.layers import Input, Lambda
@@ -9,8 +11,12 @@ from keras.models import Model
 from keras.optimizers import Adam
 from keras.callbacks import TensorBoard, ModelCheckpoint, ReduceLROnPlateau, EarlyStopping
 
-from src.yolo3.model import preprocess_true_boxes, yolo_body, tiny_yolo_body, yolo_loss
-from src.yolo3.utils import get_random_data
+from PIL import Image
+
+from src.yolo3 import postprocess
+from src.yolo3.model import preprocess_true_boxes, yolo_body, tiny_yolo_body, yolo_loss, \
+    yolo_distillation_loss, load_yolo_body
+from src.yolo3.utils import get_random_data, letterbox_image, non_max_suppression
 
 
 def _main():
@@ -23,11 +29,30 @@ def _main():
     anchors = get_anchors(anchors_path)
 
     input_shape = (416,416) # multiple of 32, hw
+    # Trained yolo_body .h5 to distill into the tiny model, None to train on labels only.
+    teacher_path = None
+    teacher_anchors_path = '../model_data/yolo_anchors.txt'
+    distill_weight = 1.0
+
+    val_split = 0.1
+    with open(annotation_path) as f:
+        lines = f.readlines()
+    np.random.seed(10101)
+    np.random.shuffle(lines)
+    np.random.seed(None)
+    num_val = int(len(lines)*val_split)
+    num_train = len(lines) - num_val
 
     is_tiny_version = len(anchors)==6 # default setting
+    teacher_outputs = None
+    if is_tiny_version and teacher_path:
+        # Run once, later runs and every epoch read the cache.
+        teacher_outputs = cache_teacher_outputs(lines, teacher_path, get_anchors(teacher_anchors_path),
+            num_classes, log_dir + 'teacher_outputs.npz', input_shape)
     if is_tiny_version:
         model = create_tiny_model(input_shape, anchors, num_classes,
-            freeze_body=2, weights_path='model_data/tiny_yolo_weights.h5')
+            freeze_body=2, weights_path='model_data/tiny_yolo_weights.h5',
+            distill_weight=distill_weight if teacher_outputs else 0)
     else:
         model = create_model(input_shape, anchors, num_classes,
             freeze_body=2, weights_path='model_data/yolo_weights.h5') # make sure you know what you freeze
@@ -38,14 +63,11 @@ def _main():
     reduce_lr = ReduceLROnPlateau(monitor='val_loss', factor=0.1, patience=3, verbose=1)
     early_stopping = EarlyStopping(monitor='val_loss', min_delta=0, patience=10, verbose=1)
 
-    val_split = 0.1
-    with open(annotation_path) as f:
-        lines = f.readlines()
-    np.random.seed(10101)
-    np.random.shuffle(lines)
-    np.random.seed(None)
-    num_val = int(len(lines)*val_split)
-    num_train = len(lines) - num_val
+    def generator(annotation_lines, batch_size, labels_only=False):
+        if teacher_outputs:
+            return distillation_data_generator(annotation_lines, batch_size, input_shape, anchors,
+                num_classes, teacher_outputs, labels_only=labels_only)
+        return data_generator_wrapper(annotation_lines, batch_size, input_shape, anchors, num_classes)
 
     # Train with frozen layers first, to get a stable loss.
     # Adjust num epochs to your dataset. This step is enough to obtain a not bad model.
@@ -56,9 +78,9 @@ def _main():
 
         batch_size = 32
         print('Train on {} samples, val on {} samples, with batch size {}.'.format(num_train, num_val, batch_size))
-        model.fit_generator(data_generator_wrapper(lines[:num_train], batch_size, input_shape, anchors, num_classes),
+        model.fit_generator(generator(lines[:num_train], batch_size),
                 steps_per_epoch=max(1, num_train//batch_size),
-                validation_data=data_generator_wrapper(lines[num_train:], batch_size, input_shape, anchors, num_classes),
+                validation_data=generator(lines[num_train:], batch_size, labels_only=True),
                 validation_steps=max(1, num_val//batch_size),
                 epochs=50,
                 initial_epoch=0,
@@ -75,9 +97,9 @@ def _main():
 
         batch_size = 32 # note that more GPU memory is required after unfreezing the body
         print('Train on {} samples, val on {} samples, with batch size {}.'.format(num_train, num_val, batch_size))
-        model.fit_generator(data_generator_wrapper(lines[:num_train], batch_size, input_shape, anchors, num_classes),
+        model.fit_generator(generator(lines[:num_train], batch_size),
             steps_per_epoch=max(1, num_train//batch_size),
-            validation_data=data_generator_wrapper(lines[num_train:], batch_size, input_shape, anchors, num_classes),
+            validation_data=generator(lines[num_train:], batch_size, labels_only=True),
             validation_steps=max(1, num_val//batch_size),
             epochs=100,
             initial_epoch=50,
@@ -125,16 +147,16 @@ def create_model(input_shape, anchors, num_classes, load_pretrained=True, freeze
             for i in range(num): model_body.layers[i].trainable = False
             print('Freeze the first {} layers of total {} layers.'.format(num, len(model_body.layers)))
 
-    model_loss = Lambda(yolo_loss, output_shape=(1,), name='yolo_loss',
-        arguments={'anchors': anchors, 'num_classes': num_classes, 'ignore_thresh': 0.5})(
-        [*model_body.output, *y_true])
-    model = Model([model_body.input, *y_true], model_loss)
-
-    return model
+    return attach_loss(model_body, y_true, anchors, num_classes, ignore_thresh=0.5)
 
 def create_tiny_model(input_shape, anchors, num_classes, load_pretrained=True, freeze_body=2,
-            weights_path='model_data/tiny_yolo_weights.h5'):
-    '''create the training model, for Tiny YOLOv3'''
+            weights_path='model_data/tiny_yolo_weights.h5', distill_weight=0):
+    '''create the training model, for Tiny YOLOv3
+
+    With distill_weight the model takes teacher targets and a per sample
+    teacher weight after y_true, see distillation_data_generator, and adds
+    their weighted loss.
+    '''
     K.clear_session() # get a new session
     image_input = Input(shape=(None, None, 3))
     h, w = input_shape
@@ -155,13 +177,33 @@ def create_tiny_model(input_shape, anchors, num_classes, load_pretrained=True, f
             for i in range(num): model_body.layers[i].trainable = False
             print('Freeze the first {} layers of total {} layers.'.format(num, len(model_body.layers)))
 
+    if distill_weight:
+        y_teacher = y_true_inputs(input_shape, anchors, num_classes)
+        teacher_weight = Input(shape=(1,))
+        model_loss = Lambda(yolo_distillation_loss, output_shape=(1,), name='yolo_loss',
+            arguments={'anchors': anchors, 'num_classes': num_classes, 'ignore_thresh': 0.7,
+                'distill_weight': distill_weight})(
+            [*model_body.output, *y_true, *y_teacher, teacher_weight])
+        return Model([model_body.input, *y_true, *y_teacher, teacher_weight], model_loss)
+
+    return attach_loss(model_body, y_true, anchors, num_classes, ignore_thresh=0.7)
+
+def attach_loss(model_body, y_true, anchors, num_classes, ignore_thresh=0.5):
+    '''wrap a model body into the training model with the yolo_loss output'''
     model_loss = Lambda(yolo_loss, output_shape=(1,), name='yolo_loss',
-        arguments={'anchors': anchors, 'num_classes': num_classes, 'ignore_thresh': 0.7})(
+        arguments={'anchors': anchors, 'num_classes': num_classes, 'ignore_thresh': ignore_thresh})(
         [*model_body.output, *y_true])
     model = Model([model_body.input, *y_true], model_loss)
 
     return model
 
+def y_true_inputs(input_shape, anchors, num_classes):
+    '''y_true inputs matching preprocess_true_boxes for input_shape (h, w)'''
+    h, w = input_shape
+    num_layers = len(anchors)//3
+    return [Input(shape=(h//{0:32, 1:16, 2:8}[l], w//{0:32, 1:16, 2:8}[l], \
+        len(anchors)//num_layers, num_classes+5)) for l in range(num_layers)]
+
 def data_generator(annotation_lines, batch_size, input_shape, anchors, num_classes):
     '''data generator for fit_generator'''
     n = len(annotation_lines)
@@ -181,6 +223,103 @@ def data_generator(annotation_lines, batch_size, input_shape, anchors, num_class
         y_true = preprocess_true_boxes(box_data, input_shape, anchors, num_classes)
         yield [image_data, *y_true], np.zeros(batch_size)
 
+def cache_teacher_outputs(annotation_lines, teacher_path, teacher_anchors, num_classes, cache_path,
+        input_shape=(416,416), score_threshold=0.3, iou_threshold=0.45, batch_size=8):
+    '''run the teacher once over every image and cache its boxes and class scores'''
+    paths = sorted(set(line.split()[0] for line in annotation_lines))
+    if os.path.exists(cache_path):
+        teacher_outputs = load_teacher_outputs(cache_path)
+        if all(path in teacher_outputs for path in paths):
+            print('Load teacher outputs from {}.'.format(cache_path))
+            return teacher_outputs
+        print('Annotations changed, rebuild {}.'.format(cache_path))
+    K.clear_session()
+    teacher = load_yolo_body(teacher_path, len(teacher_anchors), num_classes)
+    boxes, scores, counts = [], [], []
+    for i in range(0, len(paths), batch_size):
+        images = [Image.open(path).convert('RGB') for path in paths[i:i+batch_size]]
+        image_data = np.stack([np.array(letterbox_image(image, input_shape[::-1]), dtype='float32')
+            for image in images]) / 255.
+        image_index, image_boxes, image_scores = postprocess.yolo_decode(teacher.predict(image_data),
+            teacher_anchors, num_classes, [image.size[::-1] for image in images], score_threshold)
+        for j in range(len(images)):
+            mask = (image_index==j) & (image_scores.max(axis=1)>=score_threshold)
+            # Class agnostic, a box keeps the scores of all its classes.
+            keep = non_max_suppression(image_boxes[mask], image_scores[mask].max(axis=1),
+                iou_threshold=iou_threshold)
+            boxes.append(image_boxes[mask][keep][:, [1, 0, 3, 2]]) # tlbr to x_min, y_min, x_max, y_max
+            scores.append(image_scores[mask][keep])
+            counts.append(len(keep))
+    np.savez(cache_path, paths=np.array(paths), boxes=np.concatenate(boxes),
+        scores=np.concatenate(scores), counts=np.array(counts))
+    print('Teacher outputs for {} images saved to {}.'.format(len(paths), cache_path))
+    return load_teacher_outputs(cache_path)
+
+def load_teacher_outputs(cache_path):
+    '''maps every image path to the teacher boxes and class scores'''
+    cache = np.load(cache_path)
+    offsets = np.cumsum(np.concatenate([[0], cache['counts']]))
+    return {path: (cache['boxes'][start:end], cache['scores'][start:end])
+        for path, start, end in zip(cache['paths'], offsets[:-1], offsets[1:])}
+
+def distillation_data_generator(annotation_lines, batch_size, input_shape, anchors, num_classes,
+        teacher_outputs, max_boxes=20, max_teacher_boxes=50, labels_only=False):
+    '''data generator for fit_generator, also yields the teacher targets
+
+    Teacher boxes get the teacher's confidence as soft objectness, so low
+    confidence guesses weigh little. labels_only yields empty teacher targets
+    with weight 0, for validation on the labels alone.
+    '''
+    n = len(annotation_lines)
+    i = 0
+    while True:
+        image_data = []
+        box_data = []
+        teacher_box_data = []
+        teacher_score_data = []
+        for b in range(batch_size):
+            if i==0:
+                np.random.shuffle(annotation_lines)
+            line = annotation_lines[i].split()
+            if labels_only:
+                teacher_boxes, teacher_scores = np.zeros((0, 4)), np.zeros((0, num_classes))
+            else:
+                teacher_boxes, teacher_scores = teacher_outputs[line[0]]
+            teacher_boxes = teacher_boxes[:max_teacher_boxes]
+            # Teacher boxes ride along with the labels, tagged with class
+            # num_classes + index, so they get the same augmentation.
+            tagged = ['{},{},{},{},{}'.format(*np.round(box).astype('int32'), num_classes+k)
+                for k, box in enumerate(teacher_boxes)]
+            image, box = get_random_data(' '.join(line + tagged), input_shape, random=True,
+                max_boxes=max_boxes+max_teacher_boxes)
+            is_teacher = box[:, 4] >= num_classes
+            labels = np.zeros((max_boxes, 5))
+            labels[:min(max_boxes, np.sum(~is_teacher))] = box[~is_teacher][:max_boxes]
+            teacher_box = np.zeros((max_teacher_boxes, 5))
+            teacher_score = np.zeros((max_teacher_boxes, num_classes))
+            index = box[is_teacher, 4].astype('int32') - num_classes
+            teacher_box[:len(index), :4] = box[is_teacher, :4]
+            # The class column points at the row of soft class scores.
+            teacher_box[:len(index), 4] = np.arange(len(index))
+            teacher_score[:len(index)] = teacher_scores[index]
+            image_data.append(image)
+            box_data.append(labels)
+            teacher_box_data.append(teacher_box)
+            teacher_score_data.append(teacher_score)
+            i = (i+1) % n
+        image_data = np.array(image_data)
+        y_true = preprocess_true_boxes(np.array(box_data), input_shape, anchors, num_classes)
+        y_index = preprocess_true_boxes(np.array(teacher_box_data), input_shape, anchors, max_teacher_boxes)
+        teacher_score_data = np.array(teacher_score_data)
+        # Box scores are objectness times class probability, split them again.
+        confidence = teacher_score_data.max(axis=-1)
+        class_probs = teacher_score_data / np.maximum(confidence, 1e-6)[..., None]
+        y_teacher = [np.concatenate([y[..., :4],
+            np.einsum('bhwat,bt->bhwa', y[..., 5:], confidence)[..., None],
+            np.einsum('bhwat,btc->bhwac', y[..., 5:], class_probs)], axis=-1) for y in y_index]
+        teacher_weight = np.full((batch_size, 1), 0. if labels_only else 1.)
+        yield [image_data, *y_true, *y_teacher, teacher_weight], np.zeros(batch_size)
+
 def data_generator_wrapper(annotation_lines, batch_size, input_shape, anchors, num_classes):
     n = len(annotation_lines)
     if n==0 or batch_size<=0: return None
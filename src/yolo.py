@@ -4,23 +4,33 @@ Class definition of YOLO_v3 style detection model on image and video
 """
 
 import colorsys
+import json
+import queue
 import sys
+import threading
 from timeit import default_timer as timer
 
 import numpy as np
 import cv2
 
 from keras import backend as K
-from keras.models import load_model
 from keras.layers import Input
+from keras.models import Model
 from PIL import Image, ImageFont, ImageDraw
 
 import tensorflow as tf
 from tensorflow.python.framework import graph_io
-from tensorflow.keras.models import load_model
-
-from src.yolo3.model import yolo_eval, yolo_body, tiny_yolo_body
-from src.yolo3.utils import letterbox_image
+from tensorflow.core.protobuf import rewriter_config_pb2
+
+from src.yolo3.model import yolo_eval_batch, yolo_preprocess, \
+    load_yolo_body, fold_batch_norm
+from src.yolo3.utils import letterbox_image, rect_input_size, \
+    pairwise_iou, non_max_suppression, tile_origins, mean_average_precision
+from src.yolo3.tracker import IOUTracker
+from src.yolo3.cascade import CascadePolicy
+from src.yolo3.quantization import load_quantized
+from src.yolo3 import postprocess
+from src.VideoCaptureAsync import VideoCaptureAsync
 import os
 from keras.utils import multi_gpu_model
 
@@ -32,8 +42,24 @@ class YOLO(object):
             "classes_path": 'model_data/AR10_classes.txt',
             "score": 0.3,
             "iou": 0.45,
+            "max_boxes": 100,
+            "nms_mode": 'class_aware',
+            "pre_nms_top_k": 1000,
             "model_image_size": (416, 416),
+            "rect_inference": False,
+            "preprocess": False,
+            "input_channels": 'RGB',
             "gpu_num": 1,
+            "intra_op_threads": 0,
+            "inter_op_threads": 0,
+            "graph_optimization": 'default',
+            "xla_jit": False,
+            "static_input": False,
+            "fold_batchnorm": False,
+            "cascade_model_path": None,
+            "cascade_anchors_path": 'model_data/yolo_anchors.txt',
+            "cascade_band": (0.1, 0.5),
+            "cascade_refresh": 0,
     }
 
     @classmethod
@@ -47,13 +73,80 @@ class YOLO(object):
         self.__dict__.update(self._defaults)  # set up default values
         self.__dict__.update(kwargs)  # and update with user overrides
         self.yolo_model = None
+        self.interpreter = None
+        self.rect_sizes = {}
         self.class_names = self._get_class()
         self.anchors = self._get_anchors()
-        self.sess = K.get_session()
-        if os.path.expanduser(self.model_path).endswith('h5'):
+        # A cascade builds its accurate model into the session passed here.
+        self.sess = kwargs.get('sess') or self._create_session()
+        if os.path.expanduser(self.model_path).endswith(('h5', 'npz')):
             self.boxes, self.scores, self.classes = self.generate()
         elif os.path.expanduser(self.model_path).endswith('pb'):
             self.boxes, self.scores, self.classes = self.load_frozen_model()
+        elif os.path.expanduser(self.model_path).endswith('tflite'):
+            self.boxes, self.scores, self.classes = self.load_tflite_model()
+        self.cascade = None
+        if self.cascade_model_path:
+            self._build_cascade(kwargs)
+
+    def _build_cascade(self, kwargs):
+        """Load the accurate model of the cascade next to the fast one.
+
+        model_path is the fast model, run on every image; the model at
+        cascade_model_path only runs when the CascadePolicy escalates.
+        """
+        self.cascade = YOLO(**{**kwargs,
+                               'model_path': self.cascade_model_path,
+                               'anchors_path': self.cascade_anchors_path,
+                               'cascade_model_path': None,
+                               'sess': self.sess})
+        self.cascade_policy = CascadePolicy(self.cascade_band,
+                                            self.cascade_refresh)
+
+    def _session_config(self):
+        config = tf.ConfigProto(
+                intra_op_parallelism_threads=self.intra_op_threads,
+                inter_op_parallelism_threads=self.inter_op_threads)
+        rewrite_options = config.graph_options.rewrite_options
+        if self.graph_optimization == 'off':
+            rewrite_options.disable_meta_optimizer = True
+        elif self.graph_optimization == 'aggressive':
+            toggle = rewriter_config_pb2.RewriterConfig.AGGRESSIVE
+            rewrite_options.constant_folding = toggle
+            rewrite_options.arithmetic_optimization = toggle
+            rewrite_options.dependency_optimization = toggle
+            rewrite_options.remapping = toggle
+            rewrite_options.layout_optimizer = toggle
+        else:
+            assert self.graph_optimization == 'default', \
+                'graph_optimization must be default, aggressive or off'
+        if self.xla_jit:
+            config.graph_options.optimizer_options.global_jit_level = \
+                tf.OptimizerOptions.ON_1
+        return config
+
+    def _create_session(self):
+        if self.intra_op_threads == 0 and self.inter_op_threads == 0 and \
+                self.graph_optimization == 'default' and not self.xla_jit:
+            return K.get_session()
+        # The model is built in the Keras session, so it has to be ours.
+        sess = tf.Session(config=self._session_config())
+        K.set_session(sess)
+        return sess
+
+    def _generate_colors(self):
+        # Generate colors for drawing bounding boxes.
+        hsv_tuples = [(x / len(self.class_names), 1., 1.)
+                      for x in range(len(self.class_names))]
+        self.colors = list(map(lambda x: colorsys.hsv_to_rgb(*x), hsv_tuples))
+        self.colors = list(
+                map(lambda x: (
+                        int(x[0] * 255), int(x[1] * 255), int(x[2] * 255)),
+                    self.colors))
+        np.random.seed(10101)  # Fixed seed for consistent colors across runs.
+        np.random.shuffle(
+                self.colors)  # Shuffle colors to decorrelate adjacent classes.
+        np.random.seed(None)  # Reset seed to default.
 
     def _get_class(self):
         classes_path = os.path.expanduser(self.classes_path)
@@ -76,7 +169,10 @@ class YOLO(object):
 
         session = self.sess
         graph = session.graph
-        output = ['boxes', 'scores', 'classes']
+        output = ['boxes', 'scores', 'classes', 'num_detections']
+        if self.preprocess:
+            # Keep the channel order of the raw frames in the graph.
+            output.append('input_channels')
         print(f'Model output {output}')
         with graph.as_default():
             print('Freezing session...')
@@ -89,6 +185,19 @@ class YOLO(object):
                                  as_text=save_pb_as_text)
             print(f'Graph saved to: {os.path.join(save_pb_dir, save_pb_name)}')
 
+    def _frozen_input_name(self, graph_def):
+        # Prefer the signature written next to the graph by export_frozen.py.
+        signature_path = os.path.splitext(
+                os.path.expanduser(self.model_path))[0] + '.json'
+        if os.path.exists(signature_path):
+            with open(signature_path) as f:
+                return json.load(f)['inputs']['image']
+        placeholders = [node.name for node in graph_def.node
+                        if node.op == 'Placeholder' and node.name not in
+                        ('image_shape', 'raw_image', 'keras_learning_phase')]
+        assert placeholders, 'No image input found in the frozen model'
+        return placeholders[0] + ':0'
+
     def load_frozen_model(self):
         model_path = os.path.expanduser(self.model_path)
         assert model_path.endswith(
@@ -98,102 +207,392 @@ class YOLO(object):
             graph_def = tf.GraphDef()
             graph_def.ParseFromString(f.read())
 
-        # Generate colors for drawing bounding boxes.
-        hsv_tuples = [(x / len(self.class_names), 1., 1.)
-                      for x in range(len(self.class_names))]
-        self.colors = list(map(lambda x: colorsys.hsv_to_rgb(*x), hsv_tuples))
-        self.colors = list(
-                map(lambda x: (
-                        int(x[0] * 255), int(x[1] * 255), int(x[2] * 255)),
-                    self.colors))
-        np.random.seed(10101)  # Fixed seed for consistent colors across runs.
-        np.random.shuffle(
-                self.colors)  # Shuffle colors to decorrelate adjacent classes.
-        np.random.seed(None)  # Reset seed to default.
+        self._generate_colors()
 
-        tf.graph_util.import_graph_def(graph_def)
-        self.input_name = self.sess.graph_def.node[0].name + ':0'
-        self.input_image_shape = tf.get_default_graph().get_tensor_by_name(
-                'import/image_shape:0')
+        graph = tf.get_default_graph()
+        # A cascade imports a second graph into the same session, give each
+        # import its own scope so the tensors below are this model's.
+        scope = graph.unique_name('import', mark_as_used=False)
+        tf.graph_util.import_graph_def(graph_def, name=scope)
 
-        boxes_ = tf.get_default_graph().get_tensor_by_name("import/boxes:0")
-        scores_ = tf.get_default_graph().get_tensor_by_name("import/scores:0")
-        classes_ = tf.get_default_graph().get_tensor_by_name("import/classes:0")
+        def tensor(name):
+            return graph.get_tensor_by_name(scope + '/' + name)
+
+        try:
+            # Frozen with in-graph preprocessing, takes raw uint8 frames.
+            self.input_name = tensor('raw_image:0')
+            self.input_image_shape = None
+            self.preprocess = True
+            try:
+                self.input_channels = self.sess.run(
+                        tensor('input_channels:0')).decode()
+            except KeyError:
+                # Frozen before the channel order was recorded.
+                pass
+        except KeyError:
+            self.input_name = tensor(self._frozen_input_name(graph_def))
+            self.input_image_shape = tensor('image_shape:0')
+            self.preprocess = False
+
+        boxes_ = tensor('boxes:0')
+        scores_ = tensor('scores:0')
+        classes_ = tensor('classes:0')
+        try:
+            self.num_detections = tensor('num_detections:0')
+        except KeyError:
+            # Frozen before batched inference existed, one image per run.
+            self.num_detections = None
+        try:
+            self.score_threshold = tensor('score_threshold:0')
+            self.iou_threshold = tensor('iou_threshold:0')
+            self.max_boxes_tensor = tensor('max_boxes:0')
+        except KeyError:
+            # Thresholds were frozen in as constants.
+            self.score_threshold = None
+            self.iou_threshold = None
+            self.max_boxes_tensor = None
 
         return boxes_, scores_, classes_
 
+    def load_tflite_model(self):
+        """Run a model from convert_yolo_tflite.py in the TFLite interpreter.
+
+        intra_op_threads sets the interpreter threads. Decoding, unless done
+        in the model, and NMS run in NumPy, there are no graph outputs.
+        """
+        model_path = os.path.expanduser(self.model_path)
+        try:
+            self.interpreter = tf.lite.Interpreter(
+                    model_path=model_path,
+                    num_threads=self.intra_op_threads or None)
+        except TypeError:
+            # num_threads needs TF 1.15 or later.
+            self.interpreter = tf.lite.Interpreter(model_path=model_path)
+        self.interpreter.allocate_tensors()
+        self._generate_colors()
+
+        inputs = {len(detail['shape']): detail for detail in
+                  self.interpreter.get_input_details()}
+        self.input_name = inputs[4]['index']
+        self.input_image_shape = inputs[1]['index'] if 1 in inputs else None
+        self.model_image_size = tuple(int(x) for x in inputs[4]['shape'][1:3])
+        outputs = self.interpreter.get_output_details()
+        if self.input_image_shape is not None:
+            # Decoded in the model, boxes first then box_scores.
+            outputs = sorted(outputs, key=lambda d: d['name'] != 'boxes')
+        else:
+            # Raw heads, coarsest grid first as yolo_body returns them.
+            outputs = sorted(outputs, key=lambda d: d['shape'][1])
+        self.tflite_outputs = [detail['index'] for detail in outputs]
+        print('{} TFLite model loaded.'.format(model_path))
+        return None, None, None
+
+    def _detect_tflite(self, image, score=None, iou=None, max_boxes=None):
+        score = self.score if score is None else score
+        iou = self.iou if iou is None else iou
+        max_boxes = self.max_boxes if max_boxes is None else max_boxes
+        image_shape = np.array([image.size[1], image.size[0]],
+                               dtype='float32')
+        boxed_image = letterbox_image(image,
+                                      tuple(reversed(self.model_image_size)))
+        image_data = np.array(boxed_image, dtype='float32')[None] / 255.
+
+        self.interpreter.set_tensor(self.input_name, image_data)
+        if self.input_image_shape is not None:
+            self.interpreter.set_tensor(self.input_image_shape, image_shape)
+        self.interpreter.invoke()
+        outputs = [self.interpreter.get_tensor(index)
+                   for index in self.tflite_outputs]
+
+        if self.input_image_shape is not None:
+            return postprocess.yolo_nms(outputs[0][0], outputs[1][0],
+                                        max_boxes, score, iou, self.nms_mode,
+                                        pre_nms_top_k=self.pre_nms_top_k)
+        return postprocess.yolo_eval(outputs, self.anchors,
+                                     len(self.class_names), image_shape,
+                                     max_boxes, score, iou, self.nms_mode,
+                                     pre_nms_top_k=self.pre_nms_top_k)
+
     def generate(self):
         model_path = os.path.expanduser(self.model_path)
-        assert model_path.endswith(
-            '.h5'), 'Keras model or weights must be a .h5 file.'
+        assert model_path.endswith(('.h5', '.npz')), \
+            'Keras model or weights must be a .h5 file, quantized weights a .npz file.'
 
         # Load model, or construct model and load weights.
         num_anchors = len(self.anchors)
         num_classes = len(self.class_names)
-        is_tiny_version = num_anchors == 6  # default setting
-        try:
-            self.yolo_model = load_model(model_path, compile=False)
-            print('Using YOLOv3')
-        except:
-            self.yolo_model = tiny_yolo_body(Input(shape=(None, None, 3)),
-                                             num_anchors // 2, num_classes) \
-                if is_tiny_version else yolo_body(Input(shape=(None, None, 3)),
-                                                  num_anchors // 3, num_classes)
-            self.yolo_model.load_weights(
-                self.model_path)  # make sure model, anchors and classes match
-
-            print('Using tiny YOLOv3')
+        if model_path.endswith('.npz'):
+            self.yolo_model = load_quantized(model_path)
         else:
-            assert self.yolo_model.layers[-1].output_shape[-1] == \
-                   num_anchors / len(self.yolo_model.output) * (
-                               num_classes + 5), \
-                'Mismatch between model and given anchor and class sizes'
+            self.yolo_model = load_yolo_body(model_path, num_anchors,
+                                             num_classes)
+        assert self.yolo_model.layers[-1].output_shape[-1] == \
+               num_anchors / len(self.yolo_model.output) * (
+                           num_classes + 5), \
+            'Mismatch between model and given anchor and class sizes'
 
         print('{} model, anchors, and classes loaded.'.format(model_path))
+        if self.fold_batchnorm:
+            self.yolo_model = fold_batch_norm(self.yolo_model)
+            print('BatchNormalization folded into the convolutions.')
 
-        # Generate colors for drawing bounding boxes.
-        hsv_tuples = [(x / len(self.class_names), 1., 1.)
-                      for x in range(len(self.class_names))]
-        self.colors = list(map(lambda x: colorsys.hsv_to_rgb(*x), hsv_tuples))
-        self.colors = list(
-                map(lambda x: (
-                int(x[0] * 255), int(x[1] * 255), int(x[2] * 255)),
-                    self.colors))
-        np.random.seed(10101)  # Fixed seed for consistent colors across runs.
-        np.random.shuffle(
-            self.colors)  # Shuffle colors to decorrelate adjacent classes.
-        np.random.seed(None)  # Reset seed to default.
+        self._generate_colors()
 
         # Generate output tensor targets for filtered bounding boxes.
-        self.input_name = self.yolo_model.input
-        self.input_image_shape = K.placeholder(shape=(2,), name='image_shape')
-        print(self.input_image_shape)
+        if self.preprocess:
+            self.input_name = K.placeholder(shape=(None, None, None, 3),
+                                            dtype='uint8', name='raw_image')
+            # Frozen graphs read the channel order back from this constant.
+            tf.constant(self.input_channels, name='input_channels')
+        else:
+            if self.static_input:
+                # A named input of fixed size, so exported graphs have a
+                # clear signature and the grid math can be constant folded.
+                image_input = Input(
+                        shape=tuple(self.model_image_size) + (3,),
+                        name='image_input')
+                self.yolo_model = Model(image_input,
+                                        self.yolo_model(image_input))
+            self.input_name = self.yolo_model.input
+            self.input_image_shape = K.placeholder(shape=(None, 2),
+                                                   name='image_shape')
+            print(self.input_image_shape)
+        # Thresholds are graph inputs with defaults so they can be changed
+        # per call without rebuilding the graph.
+        self.score_threshold = tf.placeholder_with_default(
+                float(self.score), shape=(), name='score_threshold')
+        self.iou_threshold = tf.placeholder_with_default(
+                float(self.iou), shape=(), name='iou_threshold')
+        self.max_boxes_tensor = tf.placeholder_with_default(
+                int(self.max_boxes), shape=(), name='max_boxes')
         if self.gpu_num >= 2:
             self.yolo_model = multi_gpu_model(self.yolo_model,
                                               gpus=self.gpu_num)
 
-        boxes, scores, classes = yolo_eval(self.yolo_model.output,
-                                           self.anchors,
-                                           len(self.class_names),
-                                           self.input_image_shape,
-                                           score_threshold=self.score,
-                                           iou_threshold=self.iou)
+        if self.preprocess:
+            image_data, image_shapes = yolo_preprocess(
+                    self.input_name, self.model_image_size,
+                    bgr=self.input_channels == 'BGR',
+                    rect=self.rect_inference)
+            yolo_outputs = self.yolo_model(image_data)
+            # The frame size comes from the raw input, nothing to feed.
+            self.input_image_shape = None
+        else:
+            yolo_outputs = self.yolo_model.output
+            image_shapes = self.input_image_shape
+
+        boxes, scores, classes, self.num_detections = yolo_eval_batch(
+                yolo_outputs,
+                self.anchors,
+                len(self.class_names),
+                image_shapes,
+                max_boxes=self.max_boxes_tensor,
+                score_threshold=self.score_threshold,
+                iou_threshold=self.iou_threshold,
+                nms_mode=self.nms_mode,
+                pre_nms_top_k=self.pre_nms_top_k)
 
         return boxes, scores, classes
 
-    def detect_image(self, image):
-
+    def _rect_size(self, image_size):
+        # Few distinct source sizes per deployment, compute each once.
+        if image_size not in self.rect_sizes:
+            self.rect_sizes[image_size] = rect_input_size(
+                    image_size, max(self.model_image_size))
+        return self.rect_sizes[image_size]
+
+    def _boxed_image_size(self, images):
+        if self.rect_inference and self.model_image_size != (None, None):
+            # A batch shares one input size, take the rectangle fitting all.
+            sizes = [self._rect_size(image.size) for image in images]
+            return max(w for w, h in sizes), max(h for w, h in sizes)
         if self.model_image_size != (None, None):
             assert self.model_image_size[
                        0] % 32 == 0, 'Multiples of 32 required'
             assert self.model_image_size[
                        1] % 32 == 0, 'Multiples of 32 required'
-            boxed_image = letterbox_image(image, tuple(
-                reversed(self.model_image_size)))
-        else:
-            new_image_size = (image.width - (image.width % 32),
-                              image.height - (image.height % 32))
-            boxed_image = letterbox_image(image, new_image_size)
+            return tuple(reversed(self.model_image_size))
+        # A batch shares one input size, take the largest image in it.
+        width = max(image.width for image in images)
+        height = max(image.height for image in images)
+        return width - (width % 32), height - (height % 32)
+
+    def _learning_phase_feed(self):
+        # Nothing to feed once the learning phase was fixed, e.g. for export.
+        if isinstance(K.learning_phase(), int):
+            return {}
+        return {K.learning_phase(): 0}
+
+    def _threshold_feed(self, score=None, iou=None, max_boxes=None):
+        feed_dict = {}
+        for tensor, value in ((self.score_threshold, score),
+                              (self.iou_threshold, iou),
+                              (self.max_boxes_tensor, max_boxes)):
+            if value is None:
+                continue
+            assert tensor is not None, \
+                'Thresholds of this frozen model cannot be changed'
+            feed_dict[tensor] = value
+        return feed_dict
+
+    def detect_image(self, image, score=None, iou=None, max_boxes=None):
+        return self.detect_images([image], score, iou, max_boxes)[0]
+
+    def detect_images(self, images, score=None, iou=None, max_boxes=None):
+        """Detect objects on a list of PIL images with one session call.
+
+        score, iou and max_boxes override the model defaults for this call.
+        Returns a list holding (boxes, scores, classes) for every image.
+        """
+        if self.cascade is not None:
+            return self._detect_cascade('_detect_images', images, score, iou,
+                                        max_boxes)
+        return self._detect_images(images, score, iou, max_boxes)
+
+    def _detect_cascade(self, method, images, score=None, iou=None,
+                        max_boxes=None):
+        # method names the detect call both models run, on PIL images or
+        # on raw frames.
+        score = self.score if score is None else score
+        # The fast model runs down to the band, to see uncertain boxes.
+        fast = getattr(self, method)(
+                images, min(score, self.cascade_policy.low), iou, max_boxes)
+        escalate = [i for i, (_, scores, _) in enumerate(fast)
+                    if self.cascade_policy.needs_escalation(scores)]
+        results = [(boxes[scores >= score], scores[scores >= score],
+                    classes[scores >= score])
+                   for boxes, scores, classes in fast]
+        if escalate:
+            accurate = getattr(self.cascade, method)(
+                    [images[i] for i in escalate], score, iou, max_boxes)
+            for i, result in zip(escalate, accurate):
+                results[i] = result
+        return results
+
+    def _detect_images(self, images, score=None, iou=None, max_boxes=None):
+        if self.interpreter is not None:
+            return [self._detect_tflite(image, score, iou, max_boxes)
+                    for image in images]
+        threshold_feed = self._threshold_feed(score, iou, max_boxes)
+        if self.preprocess:
+            frames = [np.asarray(image.convert('RGB')) for image in images]
+            if self.input_channels == 'BGR':
+                # PIL images are RGB, the graph expects OpenCV order.
+                frames = [frame[..., ::-1] for frame in frames]
+            return self._detect_frames(frames, score, iou, max_boxes)
+        if self.num_detections is None:
+            return [self._detect_single_image(image, threshold_feed)
+                    for image in images]
+
+        boxed_image_size = self._boxed_image_size(images)
+        image_data = np.stack(
+                [np.array(letterbox_image(image, boxed_image_size),
+                          dtype='float32') for image in images])
+        image_data /= 255.
+
+        out_boxes, out_scores, out_classes, out_num = self.sess.run(
+                [self.boxes, self.scores, self.classes, self.num_detections],
+                feed_dict={
+                        self.input_name: image_data,
+                        self.input_image_shape: [[image.size[1], image.size[0]]
+                                                 for image in images],
+                        **self._learning_phase_feed(),
+                        **threshold_feed
+                })
+
+        return [(out_boxes[i, :n], out_scores[i, :n], out_classes[i, :n])
+                for i, n in enumerate(out_num)]
+
+    def detect_frames(self, frames, score=None, iou=None, max_boxes=None):
+        """Detect objects on raw uint8 HxWx3 frames, in input_channels order.
+
+        Needs the model built with preprocess, letterboxing and scaling run
+        inside the graph. Frames of one size share a single session call.
+        Returns a list holding (boxes, scores, classes) for every frame.
+        """
+        assert self.preprocess, 'Model was built without preprocess'
+        if self.cascade is not None:
+            return self._detect_cascade('_detect_frames', frames, score, iou,
+                                        max_boxes)
+        return self._detect_frames(frames, score, iou, max_boxes)
+
+    def _detect_frames(self, frames, score=None, iou=None, max_boxes=None):
+        threshold_feed = self._threshold_feed(score, iou, max_boxes)
+
+        groups = {}
+        for i, frame in enumerate(frames):
+            groups.setdefault(frame.shape, []).append(i)
+
+        results = [None] * len(frames)
+        for indices in groups.values():
+            out_boxes, out_scores, out_classes, out_num = self.sess.run(
+                    [self.boxes, self.scores, self.classes,
+                     self.num_detections],
+                    feed_dict={
+                            self.input_name: np.stack(
+                                    [frames[i] for i in indices]),
+                            **self._learning_phase_feed(),
+                            **threshold_feed
+                    })
+            for j, i in enumerate(indices):
+                n = out_num[j]
+                results[i] = (out_boxes[j, :n], out_scores[j, :n],
+                              out_classes[j, :n])
+        return results
+
+    def detect_image_tiled(self, image, overlap=.2, batch_size=8,
+                           prepass=False, prepass_score=.1, score=None,
+                           iou=None):
+        """Detect small objects on a large image at full resolution.
+
+        The image is cut into overlapping tiles of model_image_size that run
+        batch_size at a time. Boxes are shifted back to image coordinates and
+        duplicates along tile borders are merged with a class aware NMS.
+        With prepass, a letterboxed low resolution run at prepass_score
+        first picks the tiles that can hold an object, and its confident
+        detections take part in the merge.
+        """
+        assert self.model_image_size != (None, None), \
+            'Tiled detection needs a fixed model_image_size'
+        tile_h, tile_w = self.model_image_size
+        origins = tile_origins(image.size, (tile_w, tile_h), overlap)
+        score = self.score if score is None else score
+        iou = self.iou if iou is None else iou
+
+        boxes = [np.zeros((0, 4), dtype='float32')]
+        scores = [np.zeros((0,), dtype='float32')]
+        classes = [np.zeros((0,), dtype='int32')]
+        if prepass:
+            pre_boxes, pre_scores, pre_classes = self.detect_image(
+                    image, score=prepass_score, iou=iou)
+            tile_boxes = np.array([[top, left, top + tile_h, left + tile_w]
+                                   for left, top in origins], dtype='float32')
+            hit = (pairwise_iou(tile_boxes, pre_boxes) > 0).any(axis=1)
+            origins = [origin for origin, h in zip(origins, hit) if h]
+            confident = pre_scores >= score
+            boxes.append(pre_boxes[confident])
+            scores.append(pre_scores[confident])
+            classes.append(pre_classes[confident])
+
+        for i in range(0, len(origins), batch_size):
+            batch = origins[i:i + batch_size]
+            tiles = [image.crop((left, top, left + tile_w, top + tile_h))
+                     for left, top in batch]
+            for (left, top), (out_boxes, out_scores, out_classes) in zip(
+                    batch, self.detect_images(tiles, score, iou)):
+                boxes.append(out_boxes + np.array([top, left, top, left],
+                                                  dtype=out_boxes.dtype))
+                scores.append(out_scores)
+                classes.append(out_classes)
+
+        boxes = np.concatenate(boxes)
+        scores = np.concatenate(scores)
+        classes = np.concatenate(classes)
+        keep = non_max_suppression(boxes, scores, classes, iou_threshold=iou)
+        return boxes[keep], scores[keep], classes[keep]
+
+    def _detect_single_image(self, image, threshold_feed):
+        boxed_image = letterbox_image(image, self._boxed_image_size([image]))
         image_data = np.array(boxed_image, dtype='float32')
 
         image_data /= 255.
@@ -204,12 +603,14 @@ class YOLO(object):
                 feed_dict={
                         self.input_name: image_data,
                         self.input_image_shape: [image.size[1], image.size[0]],
-                        K.learning_phase(): 0
+                        **self._learning_phase_feed(),
+                        **threshold_feed
                 })
 
         return out_boxes, out_scores, out_classes
 
-    def annotate_image(self, image, out_boxes, out_scores, out_classes):
+    def annotate_image(self, image, out_boxes, out_scores, out_classes,
+                       track_ids=None):
         print('Found {} boxes for {}'.format(len(out_boxes), 'img'))
 
         font = ImageFont.truetype(font='font/FiraMono-Medium.otf',
@@ -225,6 +626,8 @@ class YOLO(object):
 
             #label = '{} {:.2f}'.format(predicted_class, score)
             label = f'{predicted_class}'
+            if track_ids is not None:
+                label = f'{predicted_class} #{track_ids[i]}'
             draw = ImageDraw.Draw(image)
             label_size = draw.textsize(label, font)
 
@@ -256,66 +659,47 @@ class YOLO(object):
     def close_session(self):
         self.sess.close()
 
-    def evaluate(self, validation_path, iou_thresh=0.5):
+    def evaluate(self, validation_path, iou_thresh=0.5, score=0.01):
+        """mAP and per class AP on an annotation file in the train.py format.
 
-        matches = {}
+        A low score threshold keeps the low confidence part of the precision
+        recall curve.
+        """
         with open(os.path.abspath(validation_path), 'r') as fp:
-            lines = fp.readlines()
+            lines = [line.split() for line in fp.readlines() if line.strip()]
 
-        for line in [line.split(' ') for line in lines]:
+        detections = []
+        ground_truths = []
+        for line in lines:
             source, annotations = line[0], line[1:]
-            n_objects = len(annotations)  # number of objects in the scene
             image = Image.open(source)
-            out_boxes, out_scores, out_classes = self.detect_image(image)
-
-            for annotation in annotations:
-                data = annotation.split(',')
-                bb1 = tuple(map(int, data[:4]))
-                class_ = int(data[-1])
-
-                for i in range(out_boxes.shape[0]):
-                    if class_ == out_classes[i]:
-                        top, left, bottom, right = out_boxes[i,:]
-                        top = max(0, np.floor(top + 0.5).astype('int32'))
-                        left = max(0, np.floor(left + 0.5).astype('int32'))
-                        bottom = min(image.size[1], np.floor(bottom + 0.5).astype('int32'))
-                        right = min(image.size[0], np.floor(right + 0.5).astype('int32'))
-                        bb2 = (left, top, right, bottom)
-                        iou = _compute_iou(bb1, bb2)
+            detections.append(self.detect_image(image, score=score))
+            data = np.array([list(map(float, a.split(',')))
+                             for a in annotations]).reshape(-1, 5)
+            # Annotations are (xmin, ymin, xmax, ymax), detections tlbr.
+            ground_truths.append((data[:, [1, 0, 3, 2]],
+                                  data[:, 4].astype('int32')))
 
-                        if iou > iou_thresh: # True Positive
-                            if class_ in matches:
-                                matches[class_].append(iou)
-                            else:
-                                matches[class_] = [iou]
-                        else: # False Positive
-                            pass # Every image
+        return mean_average_precision(detections, ground_truths,
+                                      len(self.class_names), iou_thresh)
 
-            #  calculate the precision for each class
-            for k, v in matches.items():
-                tp = len(v)  # true positive
-                fp = max(0, out_boxes.shape[0] - tp)  # false positive
-                precision = tp/(tp + fp)  # precision
 
+def _detect_frame(yolo, frame, image):
+    if yolo.preprocess:
+        # Hand the raw frame to the graph, no per frame PIL work.
+        return yolo.detect_frames([frame])[0]
+    return yolo.detect_image(image)
 
-def _compute_iou(groundtruth_box, detection_box):
-    g_xmin, g_ymin, g_xmax, g_ymax = groundtruth_box
-    d_xmin, d_ymin, d_xmax, d_ymax = detection_box
 
-    xa = max(g_xmin, d_xmin)
-    ya = max(g_ymin, d_ymin)
-    xb = min(g_xmax, d_xmax)
-    yb = min(g_ymax, d_ymax)
+def detect_video(yolo, video_path, output_path="", detect_every=1,
+                 min_track_confidence=0.5, motion_gate=None):
+    """Detect on a video, optionally only on every detect_every-th frame.
 
-    intersection = max(0, xb - xa + 1) * max(0, yb - ya + 1)
-
-    boxAArea = (g_xmax - g_xmin + 1) * (g_ymax - g_ymin + 1)
-    boxBArea = (d_xmax - d_xmin + 1) * (d_ymax - d_ymin + 1)
-
-    return intersection / float(boxAArea + boxBArea - intersection)
-
-
-def detect_video(yolo, video_path, output_path=""):
+    With detect_every > 1 an IOUTracker carries boxes forward in between and
+    the detector also runs early once a track has decayed below
+    min_track_confidence of its detection score. A MotionGate skips frames of a static scene and
+    reuses the last detections.
+    """
     vid = cv2.VideoCapture(video_path)
     if not vid.isOpened():
         raise IOError("Couldn't open webcam or video")
@@ -332,10 +716,28 @@ def detect_video(yolo, video_path, output_path=""):
     curr_fps = 0
     fps = "FPS: ??"
     prev_time = timer()
+    tracker = IOUTracker() if detect_every > 1 else None
+    frame_index = 0
+    detections = None
     while True:
         return_value, frame = vid.read()
+        if not return_value:
+            break
         image = Image.fromarray(frame)
-        image = yolo.annotate_image(image, *yolo.detect_image(image))
+        moved = motion_gate is None or motion_gate.needs_inference(frame)
+        if not moved and detections is not None:
+            pass  # Static scene, keep the last detections.
+        elif tracker is None:
+            detections = _detect_frame(yolo, frame, image)
+        elif frame_index % detect_every == 0 or \
+                tracker.confidence < min_track_confidence:
+            detections = tracker.update(*_detect_frame(yolo, frame, image))
+        else:
+            detections = tracker.predict()
+        image = yolo.annotate_image(
+                image, *detections[:3],
+                track_ids=detections[3] if tracker is not None else None)
+        frame_index += 1
         result = np.asarray(image)
         curr_time = timer()
         exec_time = curr_time - prev_time
@@ -357,4 +759,143 @@ def detect_video(yolo, video_path, output_path=""):
         if cv2.waitKey(1) & 0xFF == ord('q'):
             break
 
+    if motion_gate is not None:
+        print(motion_gate)
+    if yolo.cascade is not None:
+        print(yolo.cascade_policy)
+    yolo.close_session()
+
+
+class StageStats(object):
+    """Frame count and busy time of one video pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.busy_time = 0.
+
+    def add(self, seconds):
+        self.frames += 1
+        self.busy_time += seconds
+
+    @property
+    def fps(self):
+        return self.frames / self.busy_time if self.busy_time > 0 else 0.
+
+    def __str__(self):
+        return '{}: {:.1f} FPS over {} frames'.format(self.name, self.fps,
+                                                      self.frames)
+
+
+def _put(q, item, stopped):
+    # Give up on a full queue once the pipeline has been stopped.
+    while not stopped.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def detect_video_pipelined(yolo, video_path, output_path="", queue_size=8,
+                           motion_gate=None):
+    """Detect on a video with decode, inference and annotate/encode stages
+    running concurrently, connected by bounded queues.
+
+    Every stage is a single FIFO worker, so frames keep their order. Time per
+    frame approaches the slowest stage rather than the sum of all stages.
+    An optional MotionGate lets the inference stage reuse the last
+    detections while the scene is static.
+    """
+    result_queue = queue.Queue(maxsize=queue_size)
+    # Frames stay in the capture ring buffer until encoded, it has to hold
+    # everything in flight plus one slot for the decoder.
+    capture = VideoCaptureAsync(video_path, buffer_size=queue_size + 3,
+                                policy='block')
+    if not capture.cap.isOpened():
+        raise IOError("Couldn't open webcam or video")
+    video_FourCC = int(capture.get(cv2.CAP_PROP_FOURCC))
+    video_fps = capture.get(cv2.CAP_PROP_FPS)
+    video_size = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                  int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    isOutput = True if output_path != "" else False
+    if isOutput:
+        out = cv2.VideoWriter(output_path, video_FourCC, video_fps, video_size)
+
+    stopped = threading.Event()
+    inference_stats = StageStats('inference')
+    annotate_stats = StageStats('annotate/encode')
+
+    def inference():
+        detections = None
+        try:
+            while not stopped.is_set():
+                seq, frame = capture.borrow(timeout=0.1)
+                if seq is None:
+                    if capture.finished:
+                        _put(result_queue, (None, None, None), stopped)
+                        break
+                    continue
+                moved = motion_gate is None or \
+                    motion_gate.needs_inference(frame)
+                if not moved and detections is not None:
+                    pass  # Static scene, keep the last detections.
+                else:
+                    start = timer()
+                    detections = _detect_frame(yolo, frame,
+                                               Image.fromarray(frame))
+                    inference_stats.add(timer() - start)
+                if not _put(result_queue, (seq, frame, detections), stopped):
+                    break
+        except Exception as e:
+            # Hand the error to the main loop instead of leaving it waiting.
+            _put(result_queue, (None, None, e), stopped)
+            stopped.set()
+
+    worker = threading.Thread(target=inference)
+    capture.start()
+    worker.start()
+    start_time = timer()
+    frames = 0
+    error = None
+    # The GUI calls have to stay on the main thread, annotate/encode runs here.
+    while True:
+        seq, frame, detections = result_queue.get()
+        if seq is None:
+            error = detections
+            break
+        start = timer()
+        image = yolo.annotate_image(Image.fromarray(frame), *detections)
+        result = np.asarray(image)
+        cv2.namedWindow("result", cv2.WINDOW_NORMAL)
+        cv2.imshow("result", result)
+        if isOutput:
+            out.write(result)
+        capture.release(seq)
+        annotate_stats.add(timer() - start)
+        frames += 1
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            break
+
+    stopped.set()
+    capture.stop()
+    worker.join()
+    if isOutput:
+        out.release()
+    if error is not None:
+        raise RuntimeError('Inference stage failed') from error
+
+    decode_fps = capture.frames_read / capture.read_time \
+        if capture.read_time > 0 else 0.
+    print('decode: {:.1f} FPS over {} frames'.format(decode_fps,
+                                                     capture.frames_read))
+    print(inference_stats)
+    print(annotate_stats)
+    if motion_gate is not None:
+        print(motion_gate)
+    if yolo.cascade is not None:
+        print(yolo.cascade_policy)
+    print('overall: {:.1f} FPS'.format(frames / (timer() - start_time)))
+
     yolo.close_session()
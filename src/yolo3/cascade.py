@@ -0,0 +1,47 @@
+"""Escalation policy for running a small detector before a large one."""
+
+import numpy as np
+
+
+class CascadePolicy(object):
+    """Decide per frame whether the fast model's detections are enough.
+
+    A frame escalates to the accurate model when any fast detection scores
+    inside the uncertain band [low, high), or, with refresh_every > 0, when
+    that many frames passed since the last escalation. Detections below low
+    count as background and ones at or above high are trusted.
+    """
+
+    def __init__(self, band=(0.1, 0.5), refresh_every=0):
+        self.low, self.high = band
+        assert self.low <= self.high, 'band must be (low, high)'
+        self.refresh_every = refresh_every
+        self.since_escalation = 0
+        self.frames = 0
+        self.uncertain = 0
+        self.refreshed = 0
+
+    def needs_escalation(self, scores):
+        self.frames += 1
+        scores = np.asarray(scores)
+        if np.any((scores >= self.low) & (scores < self.high)):
+            self.uncertain += 1
+        elif self.refresh_every and \
+                self.since_escalation + 1 >= self.refresh_every:
+            self.refreshed += 1
+        else:
+            self.since_escalation += 1
+            return False
+        self.since_escalation = 0
+        return True
+
+    @property
+    def escalated(self):
+        return self.uncertain + self.refreshed
+
+    def __str__(self):
+        return 'cascade: {} frames, {} escalated ({:.0%}), {} uncertain, ' \
+               '{} refresh'.format(self.frames, self.escalated,
+                                   self.escalated / self.frames
+                                   if self.frames else 0.,
+                                   self.uncertain, self.refreshed)
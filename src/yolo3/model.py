@@ -1,15 +1,16 @@
 """YOLO_v3 Model Defined in Keras."""
 
 from functools import wraps
+from timeit import default_timer as timer
 
 import numpy as np
 import tensorflow as tf
 from keras import backend as K
 from keras.layers import Conv2D, Add, ZeroPadding2D, UpSampling2D, Concatenate, \
-    MaxPooling2D
+    MaxPooling2D, Input, InputLayer
 from keras.layers.advanced_activations import LeakyReLU
 from keras.layers.normalization import BatchNormalization
-from keras.models import Model
+from keras.models import Model, load_model
 from keras.regularizers import l2
 
 from src.yolo3.utils import compose
@@ -127,6 +128,368 @@ def tiny_yolo_body(inputs, num_anchors, num_classes):
     return Model(inputs, [y1, y2])
 
 
+def load_yolo_body(model_path, num_anchors, num_classes):
+    '''Full model saved in model_path, or the matching body plus its weights'''
+    try:
+        return load_model(model_path, compile=False)
+    except Exception:
+        is_tiny_version = num_anchors == 6  # default setting
+        if is_tiny_version:
+            model = tiny_yolo_body(Input(shape=(None, None, 3)),
+                                   num_anchors // 2, num_classes)
+        else:
+            model = yolo_body(Input(shape=(None, None, 3)),
+                              num_anchors // 3, num_classes)
+        model.load_weights(model_path)
+        return model
+
+
+def _layer_inputs(layer):
+    inputs = layer.get_input_at(0)
+    return inputs if isinstance(inputs, list) else [inputs]
+
+
+def _copy_model(model, replace=None):
+    '''Rebuild a functional model layer by layer on new tensors
+
+    Layers are copied with their config and weights. replace maps a layer
+    name to fn(layer, inputs) returning the output tensor to use instead,
+    inputs being the new input tensor (or list of them) of that layer.
+    '''
+    replace = replace or {}
+    tensors = {}
+    for layer in model.layers:
+        if isinstance(layer, InputLayer):
+            tensors[layer.output.name] = Input(
+                    batch_shape=layer.batch_input_shape, name=layer.name)
+            continue
+        x = [tensors[t.name] for t in _layer_inputs(layer)]
+        x = x if len(x) > 1 else x[0]
+        if layer.name in replace:
+            y = replace[layer.name](layer, x)
+        else:
+            new_layer = layer.__class__.from_config(layer.get_config())
+            y = new_layer(x)
+            new_layer.set_weights(layer.get_weights())
+        tensors[layer.get_output_at(0).name] = y
+
+    return Model([tensors[t.name] for t in model.inputs],
+                 [tensors[t.name] for t in model.outputs])
+
+
+def _conv_like(conv, x, weights, **config_updates):
+    '''Apply a copy of conv with config_updates and weights to x'''
+    config = conv.get_config()
+    config.update(config_updates)
+    new_layer = Conv2D.from_config(config)
+    y = new_layer(x)
+    new_layer.set_weights(weights)
+    return y
+
+
+def fold_batch_norm(model):
+    '''Rebuild a model for inference with BatchNormalization folded into convs
+
+    Every BatchNormalization fed only by a Conv2D is merged into that conv,
+    which gains a bias. The other layers are copied with their weights and
+    keep their names. LeakyReLU stays a separate layer.
+    '''
+    consumers = {}
+    for layer in model.layers:
+        if isinstance(layer, InputLayer):
+            continue
+        for tensor in _layer_inputs(layer):
+            consumers[tensor.name] = consumers.get(tensor.name, 0) + 1
+
+    producers = {layer.get_output_at(0).name: layer for layer in model.layers}
+    replace = {}
+    for layer in model.layers:
+        if not isinstance(layer, BatchNormalization) or \
+                layer.axis not in (-1, 3):
+            continue
+        conv = producers.get(_layer_inputs(layer)[0].name)
+        if isinstance(conv, Conv2D) and \
+                conv.data_format == 'channels_last' and \
+                consumers[conv.get_output_at(0).name] == 1:
+            # The conv passes its input through, the folded conv is built
+            # in place of the BatchNormalization.
+            replace[conv.name] = lambda layer, x: x
+            replace[layer.name] = lambda bn, x, conv=conv: _conv_like(
+                    conv, x, _fold_weights(conv, bn), use_bias=True,
+                    kernel_regularizer=None, bias_regularizer=None)
+
+    return _copy_model(model, replace)
+
+
+def prune_classes(model, num_classes, keep):
+    '''Rebuild a model whose output convs only predict the classes in keep
+
+    keep lists class indices, class i of the new model is class keep[i] of
+    the old one. Box, objectness and the kept class channels of every
+    anchor are sliced out of the final 1x1 convs, so their outputs are
+    exactly those of the full model for the kept classes.
+    '''
+    keep = np.asarray(keep, dtype='int64')
+    assert len(keep) and keep.min() >= 0 and keep.max() < num_classes, \
+        'keep must hold class indices below num_classes'
+    producers = {layer.get_output_at(0).name: layer for layer in model.layers}
+    replace = {}
+    for output in model.outputs:
+        conv = producers[output.name]
+        num_anchors = conv.filters // (num_classes + 5)
+        channels = np.concatenate([
+                a * (num_classes + 5) + np.concatenate([np.arange(5),
+                                                        5 + keep])
+                for a in range(num_anchors)])
+
+        def sliced(conv, x, channels=channels):
+            weights = [w[..., channels] for w in conv.get_weights()]
+            return _conv_like(conv, x, weights, filters=len(channels))
+
+        replace[conv.name] = sliced
+    return _copy_model(model, replace)
+
+
+def _union_channel_groups(model):
+    '''Group the convs whose outputs have to keep the same channels
+
+    Convs meeting in an Add form one group, channel preserving layers
+    (BatchNormalization, LeakyReLU, padding, resampling) pass the group on.
+    Returns the group root of every conv, the conv whose channels every
+    tensor carries (None after a Concatenate) and the BatchNormalization
+    right after every conv.
+    '''
+    parent = {}
+
+    def find(name):
+        while parent[name] != name:
+            parent[name] = parent[parent[name]]
+            name = parent[name]
+        return name
+
+    producers = {layer.get_output_at(0).name: layer for layer in model.layers}
+    source = {}
+    batch_norms = {}
+    for layer in model.layers:
+        output = layer.get_output_at(0).name
+        if isinstance(layer, InputLayer):
+            source[output] = None
+            continue
+        inputs = _layer_inputs(layer)
+        if isinstance(layer, Conv2D):
+            parent[layer.name] = layer.name
+            source[output] = layer.name
+        elif isinstance(layer, Add):
+            roots = [source[t.name] for t in inputs]
+            assert None not in roots, 'Add of a tensor not made by a conv'
+            for root in roots[1:]:
+                parent[find(root)] = find(roots[0])
+            source[output] = roots[0]
+        elif isinstance(layer, Concatenate):
+            source[output] = None
+        else:
+            source[output] = source[inputs[0].name]
+            producer = producers.get(inputs[0].name)
+            if isinstance(layer, BatchNormalization) and \
+                    isinstance(producer, Conv2D):
+                batch_norms[producer.name] = layer
+    return {name: find(name) for name in parent}, source, batch_norms
+
+
+def prune_channels(model, ratio, min_channels=8):
+    '''Rebuild a model with the least important conv filters removed
+
+    Filters are ranked by the magnitude of the BatchNormalization gamma
+    that scales them. Convs whose outputs are summed by an Add (the
+    residual stream of resblock_body) are pruned as one group ranked by
+    their mean gamma, so the Add inputs keep matching channels. Every
+    group keeps 1 - ratio of its filters, at least min_channels; the output
+    convs are never pruned. Returns the pruned model and the number of
+    filters kept per group.
+    '''
+    groups, source, batch_norms = _union_channel_groups(model)
+    convs = {layer.name: layer for layer in model.layers
+             if isinstance(layer, Conv2D)}
+    members = {}
+    for name, root in groups.items():
+        members.setdefault(root, []).append(name)
+    protected = {groups[source[t.name]] for t in model.outputs}
+    protected |= {groups[name] for name in convs if name not in batch_norms}
+
+    group_keep = {}
+    for root, names in members.items():
+        if root in protected:
+            continue
+        importance = np.mean([np.abs(batch_norms[name].get_weights()[0])
+                              for name in names], axis=0)
+        num_filters = len(importance)
+        num_keep = max(min(min_channels, num_filters),
+                       int(round(num_filters * (1. - ratio))))
+        group_keep[root] = np.sort(np.argsort(-importance)[:num_keep])
+
+    # Kept channels of every tensor, None when all are kept.
+    keep = {}
+    for layer in model.layers:
+        output = layer.get_output_at(0).name
+        if isinstance(layer, InputLayer):
+            keep[output] = None
+        elif isinstance(layer, Conv2D):
+            keep[output] = group_keep.get(groups[layer.name])
+        elif isinstance(layer, Concatenate):
+            parts = [(keep[t.name], K.int_shape(t)[-1])
+                     for t in _layer_inputs(layer)]
+            offsets = np.cumsum([0] + [channels for _, channels in parts])
+            keep[output] = None if all(k is None for k, _ in parts) else \
+                np.concatenate([(np.arange(channels) if k is None else k) +
+                                offset for (k, channels), offset in
+                                zip(parts, offsets)])
+        else:
+            keep[output] = keep[_layer_inputs(layer)[0].name]
+
+    def pruned_conv(conv, x):
+        in_keep = keep[_layer_inputs(conv)[0].name]
+        out_keep = keep[conv.get_output_at(0).name]
+        weights = conv.get_weights()
+        if in_keep is not None:
+            weights[0] = weights[0][:, :, in_keep]
+        if out_keep is not None:
+            weights = [w[..., out_keep] for w in weights]
+        return _conv_like(conv, x, weights, filters=weights[0].shape[-1])
+
+    def pruned_batch_norm(bn, x):
+        new_layer = BatchNormalization.from_config(bn.get_config())
+        y = new_layer(x)
+        new_layer.set_weights([w[keep[bn.get_output_at(0).name]]
+                               for w in bn.get_weights()])
+        return y
+
+    replace = {}
+    for layer in model.layers:
+        if isinstance(layer, Conv2D) and (
+                keep[_layer_inputs(layer)[0].name] is not None or
+                keep[layer.get_output_at(0).name] is not None):
+            replace[layer.name] = pruned_conv
+        elif isinstance(layer, BatchNormalization) and \
+                keep[layer.get_output_at(0).name] is not None:
+            replace[layer.name] = pruned_batch_norm
+
+    kept = {root: len(k) for root, k in group_keep.items()}
+    return _copy_model(model, replace), kept
+
+
+def count_flops(model, input_shape=(416, 416)):
+    '''Floating point operations of the convs of model on one input_shape
+    image, a multiply-add counting as two'''
+    shapes = {}
+    flops = 0
+    for layer in model.layers:
+        if isinstance(layer, InputLayer):
+            shapes[layer.output.name] = (1,) + tuple(input_shape) + (
+                    layer.batch_input_shape[-1],)
+            continue
+        in_shapes = [shapes[t.name] for t in _layer_inputs(layer)]
+        out_shape = layer.compute_output_shape(
+                in_shapes if len(in_shapes) > 1 else in_shapes[0])
+        shapes[layer.get_output_at(0).name] = out_shape
+        if isinstance(layer, Conv2D):
+            kernel_h, kernel_w = layer.kernel_size
+            flops += 2 * np.prod(out_shape[1:]) * kernel_h * kernel_w * \
+                in_shapes[0][-1]
+    return int(flops)
+
+
+def model_latency(model, input_shape=(416, 416), runs=10):
+    '''Milliseconds per model.predict on one random input_shape image,
+    after a warm-up run'''
+    x = np.random.rand(1, input_shape[0], input_shape[1], 3).astype('float32')
+    model.predict(x)
+    start = timer()
+    for _ in range(runs):
+        model.predict(x)
+    return 1000. * (timer() - start) / runs
+
+
+def _fold_weights(conv, bn):
+    '''Kernel and bias of conv followed by bn, as one biased conv.'''
+    weights = conv.get_weights()
+    kernel = weights[0]
+    bias = weights[1] if conv.use_bias else np.zeros(kernel.shape[-1])
+    bn_weights = list(bn.get_weights())
+    gamma = bn_weights.pop(0) if bn.scale else np.ones(kernel.shape[-1])
+    beta = bn_weights.pop(0) if bn.center else np.zeros(kernel.shape[-1])
+    mean, variance = bn_weights
+    scale = gamma / np.sqrt(variance + bn.epsilon)
+    return [kernel * scale, (bias - mean) * scale + beta]
+
+
+def verify_fold(model, folded_model, input_shape=(416, 416), batch_size=2,
+                atol=1e-3):
+    '''Max absolute output difference between model and folded_model.
+
+    Both run on the same random batch; raises AssertionError above atol.
+    '''
+    x = np.random.rand(batch_size, input_shape[0], input_shape[1],
+                       3).astype('float32')
+    expected = model.predict(x)
+    actual = folded_model.predict(x)
+    expected = expected if isinstance(expected, list) else [expected]
+    actual = actual if isinstance(actual, list) else [actual]
+    error = max(np.abs(a - e).max() for a, e in zip(actual, expected))
+    assert error <= atol, 'Folded model differs by {}'.format(error)
+    return error
+
+
+def yolo_preprocess(images, model_image_size=(416, 416), bgr=False,
+                    rect=False):
+    '''Letterbox a batch of raw uint8 frames inside the graph
+
+    Parameters
+    ----------
+    images: tensor, shape=(batch, h, w, 3), uint8 frames of one size
+    model_image_size: hw, multiples of 32, or (None, None) to use the frame
+        size rounded down to a multiple of 32
+    bgr: bool, the frames are BGR (OpenCV) and need their channels swapped
+    rect: bool, letterbox to the smallest multiple of 32 rectangle that
+        keeps the frame aspect ratio, with the long side of model_image_size
+
+    Returns
+    -------
+    image_data: tensor, shape=(batch, h, w, 3), float RGB in [0, 1]
+    image_shapes: tensor, shape=(batch, 2), hw of the original frames
+
+    '''
+    if bgr:
+        images = images[..., ::-1]
+    images = K.cast(images, K.floatx())
+    image_shape = K.shape(images)[1:3]
+    image_hw = K.cast(image_shape, K.floatx())
+    if model_image_size == (None, None):
+        input_shape = image_shape - image_shape % 32
+    elif rect:
+        # Integer ceil, the same rounding as rect_input_size.
+        input_shape = -(-image_shape * max(model_image_size) //
+                        K.max(image_shape) // 32) * 32
+    else:
+        input_shape = K.constant(model_image_size, dtype='int32')
+
+    input_hw = K.cast(input_shape, K.floatx())
+    scale = K.min(input_hw / image_hw)
+    new_shape = K.cast(image_hw * scale, 'int32')
+    images = tf.image.resize_images(images, new_shape,
+                                    method=tf.image.ResizeMethod.BICUBIC)
+    images = K.clip(images, 0., 255.)
+
+    # Pad with grey around the resized frame, as letterbox_image does.
+    offset = (input_shape - new_shape) // 2
+    images = tf.image.pad_to_bounding_box(images - 128., offset[0], offset[1],
+                                          input_shape[0], input_shape[1])
+    image_data = (images + 128.) / 255.
+
+    image_shapes = K.tile(K.expand_dims(image_shape, 0),
+                          [K.shape(images)[0], 1])
+    return image_data, image_shapes
+
+
 def yolo_head(feats, anchors, num_classes, input_shape, calc_loss=False):
     """Convert final layer features to bounding box parameters."""
     num_anchors = len(anchors)
@@ -164,7 +527,8 @@ def yolo_correct_boxes(box_xy, box_wh, input_shape, image_shape):
     box_hw = box_wh[..., ::-1]
     input_shape = K.cast(input_shape, K.dtype(box_yx))
     image_shape = K.cast(image_shape, K.dtype(box_yx))
-    new_shape = K.round(image_shape * K.min(input_shape / image_shape))
+    new_shape = K.round(image_shape * K.min(input_shape / image_shape,
+                                            axis=-1, keepdims=True))
     offset = (input_shape - new_shape) / 2. / input_shape
     scale = input_shape / new_shape
     box_yx = (box_yx - offset) * scale
@@ -185,46 +549,77 @@ def yolo_correct_boxes(box_xy, box_wh, input_shape, image_shape):
 
 
 def yolo_boxes_and_scores(feats, anchors, num_classes, input_shape,
-                          image_shape):
+                          image_shape, keep_batch=False, split_scores=False):
     '''Process Conv layer output'''
     box_xy, box_wh, box_confidence, box_class_probs = yolo_head(feats,
                                                                 anchors,
                                                                 num_classes,
                                                                 input_shape)
     boxes = yolo_correct_boxes(box_xy, box_wh, input_shape, image_shape)
-    boxes = K.reshape(boxes, [-1, 4])
+    shape = [K.shape(feats)[0], -1] if keep_batch else [-1]
+    boxes = K.reshape(boxes, shape + [4])
+    if split_scores:
+        # Class scores are left to the caller, see _pre_nms_candidates.
+        return boxes, K.reshape(box_confidence, shape + [1]), \
+            K.reshape(box_class_probs, shape + [num_classes])
     box_scores = box_confidence * box_class_probs
-    box_scores = K.reshape(box_scores, [-1, num_classes])
+    box_scores = K.reshape(box_scores, shape + [num_classes])
     return boxes, box_scores
 
 
-def yolo_eval(yolo_outputs,
-              anchors,
-              num_classes,
-              image_shape,
-              max_boxes=20,
-              score_threshold=.6,
-              iou_threshold=.5):
-    """Evaluate YOLO model on given input and return filtered boxes."""
+def yolo_decode(yolo_outputs, anchors, num_classes, image_shape,
+                keep_batch=False, split_scores=False):
+    '''Decode every output layer into boxes and per class box scores.
+
+    With keep_batch the results have shape (batch, num_boxes, 4) and
+    (batch, num_boxes, num_classes), otherwise the batch axis is flattened.
+    With split_scores objectness and class probabilities are returned
+    separately instead of their product.
+    '''
     num_layers = len(yolo_outputs)
     anchor_mask = [[6, 7, 8], [3, 4, 5], [0, 1, 2]] if num_layers == 3 else [
             [3, 4, 5], [1, 2, 3]]  # default setting
     input_shape = K.shape(yolo_outputs[0])[1:3] * 32
-    boxes = []
-    box_scores = []
+    decoded = []
     for l in range(num_layers):
-        _boxes, _box_scores = yolo_boxes_and_scores(yolo_outputs[l],
-                                                    anchors[anchor_mask[l]],
-                                                    num_classes,
-                                                    input_shape,
-                                                    image_shape)
-        boxes.append(_boxes)
-        box_scores.append(_box_scores)
-    boxes = K.concatenate(boxes, axis=0)
-    box_scores = K.concatenate(box_scores, axis=0)
-
+        decoded.append(yolo_boxes_and_scores(yolo_outputs[l],
+                                             anchors[anchor_mask[l]],
+                                             num_classes,
+                                             input_shape,
+                                             image_shape,
+                                             keep_batch=keep_batch,
+                                             split_scores=split_scores))
+    axis = 1 if keep_batch else 0
+    return tuple(K.concatenate(list(parts), axis=axis)
+                 for parts in zip(*decoded))
+
+
+def _pre_nms_candidates(boxes, box_confidence, box_class_probs,
+                        score_threshold, top_k=None):
+    '''Boxes and class scores of the boxes of one image worth scoring
+
+    Class probabilities are at most 1, so a box whose objectness is below
+    score_threshold cannot pass it in any class; such boxes are dropped
+    before any class score is computed. With top_k only the top_k remaining
+    boxes by objectness are kept, which bounds the NMS work on crowded
+    images. Kept boxes stay in decode order.
+    '''
+    objectness = box_confidence[:, 0]
+    index = tf.where(objectness >= score_threshold)[:, 0]
+    if top_k:
+        k = K.minimum(top_k, K.shape(index)[0])
+        _, top = tf.nn.top_k(K.gather(objectness, index), k)
+        index = tf.sort(K.gather(index, top))
+    box_scores = K.gather(box_confidence, index) * \
+        K.gather(box_class_probs, index)
+    return K.gather(boxes, index), box_scores
+
+
+def per_class_nms(boxes, box_scores, num_classes, max_boxes=20,
+                  score_threshold=.6, iou_threshold=.5):
+    '''Run non max suppression separately for every class of one image'''
     mask = box_scores >= score_threshold
-    max_boxes_tensor = K.constant(max_boxes, dtype='int32')
+    max_boxes_tensor = K.cast(max_boxes, 'int32')
     boxes_ = []
     scores_ = []
     classes_ = []
@@ -244,6 +639,78 @@ def yolo_eval(yolo_outputs,
     boxes_ = K.concatenate(boxes_, axis=0)
     scores_ = K.concatenate(scores_, axis=0)
     classes_ = K.concatenate(classes_, axis=0)
+    return boxes_, scores_, classes_
+
+
+def class_aware_nms(boxes, box_scores, max_boxes=100, score_threshold=.6,
+                    iou_threshold=.5):
+    '''Run a single non max suppression over all classes of one image
+
+    Every (box, class) pair above score_threshold is a candidate. Candidates
+    are shifted apart by a per class coordinate offset so boxes of different
+    classes never overlap, which lets one NMS op stand in for a loop over
+    the classes. max_boxes caps the total number of detections, not the
+    number per class.
+    '''
+    candidates = tf.where(box_scores >= score_threshold)
+    candidate_boxes = K.gather(boxes, candidates[:, 0])
+    candidate_scores = tf.gather_nd(box_scores, candidates)
+    candidate_classes = K.cast(candidates[:, 1], 'int32')
+
+    offset = K.max(K.abs(boxes)) + 1.
+    offset_boxes = candidate_boxes + K.expand_dims(
+            K.cast(candidate_classes, K.dtype(boxes)) * offset, -1)
+    nms_index = tf.image.non_max_suppression(
+            offset_boxes, candidate_scores,
+            K.cast(max_boxes, 'int32'),
+            iou_threshold=iou_threshold)
+
+    boxes_ = K.gather(candidate_boxes, nms_index)
+    scores_ = K.gather(candidate_scores, nms_index)
+    classes_ = K.gather(candidate_classes, nms_index)
+    return boxes_, scores_, classes_
+
+
+def _nms(boxes, box_scores, num_classes, max_boxes, score_threshold,
+         iou_threshold, nms_mode):
+    if nms_mode == 'class_aware':
+        return class_aware_nms(boxes, box_scores, max_boxes=max_boxes,
+                               score_threshold=score_threshold,
+                               iou_threshold=iou_threshold)
+    elif nms_mode == 'per_class':
+        return per_class_nms(boxes, box_scores, num_classes,
+                             max_boxes=max_boxes,
+                             score_threshold=score_threshold,
+                             iou_threshold=iou_threshold)
+    raise ValueError('Unknown nms_mode: {}'.format(nms_mode))
+
+
+def yolo_eval(yolo_outputs,
+              anchors,
+              num_classes,
+              image_shape,
+              max_boxes=20,
+              score_threshold=.6,
+              iou_threshold=.5,
+              nms_mode='per_class',
+              pre_nms_top_k=None):
+    """Evaluate YOLO model on given input and return filtered boxes.
+
+    nms_mode 'per_class' keeps up to max_boxes detections for every class,
+    'class_aware' runs one NMS over all classes and keeps max_boxes in total.
+    max_boxes, score_threshold and iou_threshold may also be scalar tensors,
+    so they can be fed at run time. Boxes are filtered on objectness first
+    and capped to pre_nms_top_k before scoring, see _pre_nms_candidates.
+    """
+    boxes, box_confidence, box_class_probs = yolo_decode(
+            yolo_outputs, anchors, num_classes, image_shape,
+            split_scores=True)
+    boxes, box_scores = _pre_nms_candidates(boxes, box_confidence,
+                                            box_class_probs, score_threshold,
+                                            pre_nms_top_k)
+    boxes_, scores_, classes_ = _nms(boxes, box_scores, num_classes,
+                                     max_boxes, score_threshold,
+                                     iou_threshold, nms_mode)
 
     # Apply identity to tensor so they can be identified by name
     boxes_ = K.identity(boxes_, name='boxes')
@@ -253,6 +720,70 @@ def yolo_eval(yolo_outputs,
     return boxes_, scores_, classes_
 
 
+def yolo_eval_batch(yolo_outputs,
+                    anchors,
+                    num_classes,
+                    image_shapes,
+                    max_boxes=20,
+                    score_threshold=.6,
+                    iou_threshold=.5,
+                    nms_mode='per_class',
+                    pre_nms_top_k=None):
+    '''Evaluate YOLO model on a batch of images and return filtered boxes
+
+    Parameters
+    ----------
+    yolo_outputs: list of tensor, the output of yolo_body or tiny_yolo_body
+    anchors: array, shape=(N, 2), wh
+    num_classes: integer
+    image_shapes: tensor, shape=(batch, 2), hw of every original image
+    nms_mode: 'per_class' or 'class_aware', see yolo_eval
+    pre_nms_top_k: integer or None, cap on the boxes per image that get
+        class scores and go into NMS, see _pre_nms_candidates
+
+    Returns
+    -------
+    boxes: tensor, shape=(batch, max_detections, 4)
+    scores: tensor, shape=(batch, max_detections)
+    classes: tensor, shape=(batch, max_detections)
+    num_detections: tensor, shape=(batch,), number of valid rows per image
+
+    '''
+    image_shapes = K.reshape(image_shapes, [-1, 1, 1, 1, 2])
+    boxes, box_confidence, box_class_probs = yolo_decode(
+            yolo_outputs, anchors, num_classes, image_shapes,
+            keep_batch=True, split_scores=True)
+    max_detections = max_boxes if nms_mode == 'class_aware' else \
+        num_classes * max_boxes
+
+    def eval_image(args):
+        image_boxes, image_box_scores = _pre_nms_candidates(
+                *args, score_threshold, pre_nms_top_k)
+        boxes_, scores_, classes_ = _nms(image_boxes, image_box_scores,
+                                         num_classes, max_boxes,
+                                         score_threshold, iou_threshold,
+                                         nms_mode)
+        # Pad every image to the same length so map_fn can stack them.
+        num_detections = K.shape(scores_)[0]
+        pad = max_detections - num_detections
+        boxes_ = tf.pad(boxes_, [[0, pad], [0, 0]])
+        scores_ = tf.pad(scores_, [[0, pad]])
+        classes_ = tf.pad(classes_, [[0, pad]])
+        return boxes_, scores_, classes_, num_detections
+
+    boxes_, scores_, classes_, num_detections_ = tf.map_fn(
+            eval_image, (boxes, box_confidence, box_class_probs),
+            dtype=(K.dtype(boxes), K.dtype(box_confidence), 'int32', 'int32'))
+
+    # Apply identity to tensor so they can be identified by name
+    boxes_ = K.identity(boxes_, name='boxes')
+    scores_ = K.identity(scores_, name='scores')
+    classes_ = K.identity(classes_, name='classes')
+    num_detections_ = K.identity(num_detections_, name='num_detections')
+
+    return boxes_, scores_, classes_, num_detections_
+
+
 def preprocess_true_boxes(true_boxes, input_shape, anchors, num_classes):
     '''Preprocess true boxes to training input format
 
@@ -465,3 +996,34 @@ def yolo_loss(args, anchors, num_classes, ignore_thresh=.5, print_loss=False):
                                    class_loss, K.sum(ignore_mask)],
                             message='loss: ')
     return loss
+
+
+def yolo_distillation_loss(args, anchors, num_classes, ignore_thresh=.5,
+                           distill_weight=1., print_loss=False):
+    '''Return yolo_loss on the labels plus a weighted loss on teacher targets
+
+    Parameters
+    ----------
+    args: list of tensor, [*yolo_outputs, *y_true, *y_teacher, teacher_weight]
+    y_teacher: list of tensor, preprocess_true_boxes layout built from the
+        teacher's boxes, with the teacher's confidence as soft objectness
+        and its class scores as soft class targets
+    teacher_weight: tensor, shape=(batch, 1), 1 to train on the teacher
+        targets, 0 to leave them out (validation on labels only)
+    distill_weight: float, weight of the teacher term
+
+    Returns
+    -------
+    loss: tensor, shape=(1,)
+
+    '''
+    num_layers = len(anchors) // 3  # default setting
+    yolo_outputs = args[:num_layers]
+    y_true = args[num_layers:2 * num_layers]
+    y_teacher = args[2 * num_layers:3 * num_layers]
+    teacher_weight = K.mean(args[3 * num_layers])
+    return yolo_loss([*yolo_outputs, *y_true], anchors, num_classes,
+                     ignore_thresh, print_loss) + \
+        distill_weight * teacher_weight * yolo_loss(
+                [*yolo_outputs, *y_teacher], anchors, num_classes,
+                ignore_thresh, print_loss)
@@ -0,0 +1,57 @@
+"""Cheap frame-difference gate to skip inference on static scenes."""
+
+import numpy as np
+
+
+class MotionGate(object):
+    """Decide per frame whether the scene changed enough to run the detector.
+
+    Frames are reduced to a small grey image by striding, then compared with
+    a running-average background. Inference is needed when more than
+    area_threshold of the pixels differ by over pixel_threshold grey levels,
+    or when max_skip frames in a row were skipped.
+    """
+
+    def __init__(self, size=64, pixel_threshold=25, area_threshold=0.01,
+                 learning_rate=0.05, max_skip=250):
+        self.size = size
+        self.pixel_threshold = pixel_threshold
+        self.area_threshold = area_threshold
+        self.learning_rate = learning_rate
+        self.max_skip = max_skip
+        self.background = None
+        self.skipped_in_row = 0
+        self.processed = 0
+        self.skipped = 0
+
+    def _downsample(self, frame):
+        frame = np.asarray(frame)
+        step = max(1, max(frame.shape[:2]) // self.size)
+        small = frame[::step, ::step]
+        if small.ndim == 3:
+            small = small.mean(axis=2)
+        return small.astype('float32')
+
+    def needs_inference(self, frame):
+        small = self._downsample(frame)
+        if self.background is None or self.background.shape != small.shape:
+            changed = True
+            self.background = small
+        else:
+            diff = np.abs(small - self.background) > self.pixel_threshold
+            changed = diff.mean() > self.area_threshold
+            self.background += self.learning_rate * (small - self.background)
+
+        if changed or self.skipped_in_row >= self.max_skip:
+            self.skipped_in_row = 0
+            self.processed += 1
+            return True
+        self.skipped_in_row += 1
+        self.skipped += 1
+        return False
+
+    def __str__(self):
+        total = self.processed + self.skipped
+        return 'motion gate: {} processed, {} skipped ({:.0%})'.format(
+                self.processed, self.skipped,
+                self.skipped / total if total else 0.)
@@ -0,0 +1,186 @@
+"""YOLO_v3 box decoding and NMS in NumPy.
+
+Same semantics as the graph functions of the same name in yolo3/model.py,
+for backends that return the raw head outputs (TFLite, cached outputs).
+Decoding is batched and starts from objectness: a box score is objectness
+times a class probability, so cells with objectness below the score
+threshold are dropped before their boxes and class scores are computed.
+With pre_nms_top_k only that many boxes per image, by objectness, go on to
+NMS, as in the graph.
+"""
+
+import numpy as np
+
+from src.yolo3.utils import non_max_suppression, fast_non_max_suppression
+
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+
+def _anchor_mask(num_layers):
+    return [[6, 7, 8], [3, 4, 5], [0, 1, 2]] if num_layers == 3 else [
+            [3, 4, 5], [1, 2, 3]]  # default setting
+
+
+def yolo_correct_boxes(box_xy, box_wh, input_shape, image_shape):
+    '''Get corrected boxes'''
+    box_yx = box_xy[..., ::-1]
+    box_hw = box_wh[..., ::-1]
+    input_shape = np.asarray(input_shape, dtype=box_yx.dtype)
+    image_shape = np.asarray(image_shape, dtype=box_yx.dtype)
+    new_shape = np.round(image_shape * np.min(input_shape / image_shape,
+                                              axis=-1, keepdims=True))
+    offset = (input_shape - new_shape) / 2. / input_shape
+    scale = input_shape / new_shape
+    box_yx = (box_yx - offset) * scale
+    box_hw = box_hw * scale
+
+    box_mins = box_yx - (box_hw / 2.)
+    box_maxes = box_yx + (box_hw / 2.)
+    boxes = np.concatenate([box_mins, box_maxes], axis=-1)
+
+    # Scale boxes back to original image shape.
+    boxes *= np.concatenate([image_shape, image_shape], axis=-1)
+    return boxes
+
+
+def yolo_boxes_and_scores(feats, anchors, num_classes, input_shape,
+                          image_shapes, score_threshold=0.):
+    '''Decode the cells of one output layer that can pass score_threshold
+
+    feats has shape (batch, h, w, num_anchors * (num_classes + 5)) and
+    image_shapes (batch, 2). Returns the image index, boxes and class scores
+    of every kept (cell, anchor), in the order the graph decodes them, and
+    their objectness.
+    '''
+    num_anchors = len(anchors)
+    batch_size, grid_h, grid_w = feats.shape[:3]
+    feats = feats.reshape(
+            (batch_size, grid_h, grid_w, num_anchors, num_classes + 5))
+    box_confidence = sigmoid(feats[..., 4])
+    b, y, x, a = np.nonzero(box_confidence >= score_threshold)
+    cells = feats[b, y, x, a]
+
+    grid = np.stack([x, y], axis=-1).astype(feats.dtype)
+    box_xy = (sigmoid(cells[:, :2]) + grid) / np.array([grid_w, grid_h],
+                                                       dtype=feats.dtype)
+    box_wh = np.exp(cells[:, 2:4]) * np.asarray(
+            anchors, dtype=feats.dtype)[a] / np.array(input_shape[::-1],
+                                                     dtype=feats.dtype)
+    boxes = yolo_correct_boxes(box_xy, box_wh, input_shape, image_shapes[b])
+    objectness = box_confidence[b, y, x, a]
+    box_scores = objectness[:, None] * sigmoid(cells[:, 5:])
+    return b, boxes, box_scores, objectness
+
+
+def _top_k(ranking, top_k):
+    '''Indices of the top_k highest ranking entries, kept in their order'''
+    if not top_k or len(ranking) <= top_k:
+        return np.arange(len(ranking))
+    # Stable, so ties go to the earlier box as with tf.nn.top_k.
+    return np.sort(np.argsort(-ranking, kind='stable')[:top_k])
+
+
+def yolo_decode(yolo_outputs, anchors, num_classes, image_shapes,
+                score_threshold=0., pre_nms_top_k=None):
+    '''Decode every output layer of a batch, see yolo_boxes_and_scores
+
+    With pre_nms_top_k only the pre_nms_top_k boxes of every image with the
+    highest objectness are returned, see _pre_nms_candidates in
+    yolo3/model.py.
+    '''
+    anchor_mask = _anchor_mask(len(yolo_outputs))
+    input_shape = np.array(yolo_outputs[0].shape[1:3]) * 32
+    image_shapes = np.asarray(image_shapes, dtype='float32').reshape(-1, 2)
+    decoded = [yolo_boxes_and_scores(feats, anchors[anchor_mask[l]],
+                                     num_classes, input_shape, image_shapes,
+                                     score_threshold)
+               for l, feats in enumerate(yolo_outputs)]
+    image_index, boxes, box_scores, objectness = (
+            np.concatenate(parts) for parts in zip(*decoded))
+    if pre_nms_top_k:
+        keep = np.concatenate([np.zeros((0,), dtype='int64')] + [
+                index[_top_k(objectness[index], pre_nms_top_k)]
+                for index in (np.nonzero(image_index == i)[0]
+                              for i in range(len(image_shapes)))])
+        image_index, boxes, box_scores = \
+            image_index[keep], boxes[keep], box_scores[keep]
+    return image_index, boxes, box_scores
+
+
+def yolo_nms(boxes, box_scores, max_boxes=20, score_threshold=.6,
+             iou_threshold=.5, nms_mode='per_class', fast_nms=False,
+             pre_nms_top_k=None):
+    '''NMS on decoded boxes of one image, see _nms in yolo3/model.py
+
+    fast_nms swaps the greedy NMS for fast_non_max_suppression.
+    pre_nms_top_k is for boxes decoded without their objectness (TFLite
+    models that decode in the graph): it keeps the boxes with the highest
+    class score, which ranks like objectness for all but near ties.
+    '''
+    nms = fast_non_max_suppression if fast_nms else non_max_suppression
+    if pre_nms_top_k:
+        best = box_scores.max(axis=-1, initial=0.)
+        keep = np.nonzero(best >= score_threshold)[0]
+        keep = keep[_top_k(best[keep], pre_nms_top_k)]
+        boxes, box_scores = boxes[keep], box_scores[keep]
+    candidates, classes = np.nonzero(box_scores >= score_threshold)
+    candidate_boxes = boxes[candidates]
+    candidate_scores = box_scores[candidates, classes]
+    if nms_mode == 'class_aware':
+        keep = nms(candidate_boxes, candidate_scores, classes,
+                   iou_threshold, max_boxes)
+    elif nms_mode == 'per_class':
+        keep = [np.nonzero(classes == c)[0] for c in np.unique(classes)]
+        keep = np.concatenate([np.zeros((0,), dtype='int64')] + [
+                index[nms(candidate_boxes[index], candidate_scores[index],
+                          iou_threshold=iou_threshold, max_boxes=max_boxes)]
+                for index in keep])
+    else:
+        raise ValueError('Unknown nms_mode: {}'.format(nms_mode))
+    return candidate_boxes[keep], candidate_scores[keep], \
+        classes[keep].astype('int32')
+
+
+def yolo_eval_batch(yolo_outputs,
+                    anchors,
+                    num_classes,
+                    image_shapes,
+                    max_boxes=20,
+                    score_threshold=.6,
+                    iou_threshold=.5,
+                    nms_mode='per_class',
+                    fast_nms=False,
+                    pre_nms_top_k=None):
+    """Evaluate raw YOLO outputs of a batch of images.
+
+    image_shapes holds the hw of every original image. Returns a list with
+    (boxes, scores, classes) for every image.
+    """
+    image_index, boxes, box_scores = yolo_decode(
+            yolo_outputs, anchors, num_classes, image_shapes, score_threshold,
+            pre_nms_top_k)
+    results = []
+    for i in range(len(yolo_outputs[0])):
+        mask = image_index == i
+        results.append(yolo_nms(boxes[mask], box_scores[mask], max_boxes,
+                                score_threshold, iou_threshold, nms_mode,
+                                fast_nms))
+    return results
+
+
+def yolo_eval(yolo_outputs,
+              anchors,
+              num_classes,
+              image_shape,
+              max_boxes=20,
+              score_threshold=.6,
+              iou_threshold=.5,
+              nms_mode='per_class',
+              fast_nms=False,
+              pre_nms_top_k=None):
+    """Evaluate raw YOLO outputs of one image and return filtered boxes."""
+    return yolo_eval_batch(yolo_outputs, anchors, num_classes, [image_shape],
+                           max_boxes, score_threshold, iou_threshold,
+                           nms_mode, fast_nms, pre_nms_top_k)[0]
@@ -0,0 +1,93 @@
+"""Post-training weight quantization of YOLO models.
+
+Weights are stored as float16, or as int8 with one float32 scale per output
+channel for conv kernels (biases and BatchNormalization stay float32). The
+.npz also holds the model architecture, load_quantized rebuilds the model and
+dequantizes the weights to float32, so only storage and load are affected.
+"""
+
+import numpy as np
+from keras.layers import Conv2D
+from keras.models import model_from_json
+
+MODES = ('float16', 'int8')
+
+
+def quantize_per_channel(kernel, percentile=100.):
+    '''Symmetric int8 kernel and float32 scale per output channel
+
+    percentile below 100 clips outlier weights of a channel, trading their
+    error for a finer step on all the others.
+    '''
+    axes = tuple(range(kernel.ndim - 1))
+    limit = np.percentile(np.abs(kernel), percentile, axis=axes)
+    scale = np.maximum(limit, 1e-12).astype('float32') / 127.
+    quantized = np.clip(np.round(kernel / scale), -127, 127).astype('int8')
+    return quantized, scale
+
+
+def quantize_weights(model, mode='int8', percentile=100.):
+    '''Arrays for every weight of model, keyed layer_name/index'''
+    assert mode in MODES, 'mode must be float16 or int8'
+    arrays = {}
+    for layer in model.layers:
+        for i, weight in enumerate(layer.get_weights()):
+            key = '{}/{}'.format(layer.name, i)
+            if mode == 'float16':
+                arrays[key] = weight.astype('float16')
+            elif isinstance(layer, Conv2D) and i == 0:
+                arrays[key + '/int8'], arrays[key + '/scale'] = \
+                    quantize_per_channel(weight, percentile)
+            else:
+                arrays[key] = weight
+    return arrays
+
+
+def dequantize_weights(arrays, model):
+    '''Load arrays from quantize_weights into model as float32'''
+    for layer in model.layers:
+        weights = []
+        for i in range(len(layer.weights)):
+            key = '{}/{}'.format(layer.name, i)
+            if key + '/int8' in arrays:
+                weights.append(arrays[key + '/int8'].astype('float32') *
+                               arrays[key + '/scale'])
+            else:
+                weights.append(arrays[key].astype('float32'))
+        if weights:
+            layer.set_weights(weights)
+    return model
+
+
+def save_quantized(model, path, mode='int8', percentile=100.):
+    arrays = quantize_weights(model, mode, percentile)
+    np.savez(path, __model__=np.array(model.to_json()),
+             __mode__=np.array(mode), **arrays)
+
+
+def load_quantized(path):
+    arrays = np.load(path)
+    model = model_from_json(str(arrays['__model__']))
+    return dequantize_weights(arrays, model)
+
+
+def calibrate(model, images, percentiles=(100., 99.99, 99.9)):
+    '''Clipping percentile with the smallest int8 head output error
+
+    images is a float32 batch of model inputs. The error of a candidate is
+    the squared error of all head outputs relative to their float32 energy.
+    Returns the best percentile and the error of every candidate.
+    '''
+    expected = model.predict(images)
+    expected = expected if isinstance(expected, list) else [expected]
+    energy = sum(np.sum(np.square(e)) for e in expected)
+    candidate = model_from_json(model.to_json())
+    errors = {}
+    for percentile in percentiles:
+        dequantize_weights(quantize_weights(model, 'int8', percentile),
+                           candidate)
+        actual = candidate.predict(images)
+        actual = actual if isinstance(actual, list) else [actual]
+        errors[percentile] = sum(np.sum(np.square(a - e)) for a, e in
+                                 zip(actual, expected)) / energy
+    return min(errors, key=errors.get), errors
@@ -0,0 +1,115 @@
+"""Lightweight IoU tracker to carry detections between detector runs."""
+
+import numpy as np
+
+from src.yolo3.utils import pairwise_iou
+
+
+class IOUTracker(object):
+    """Associate detections to tracks by IoU and predict with constant velocity.
+
+    Boxes are (top, left, bottom, right) as returned by YOLO.detect_image.
+    Between detector runs predict() moves every track by its velocity and
+    decays its confidence, so callers can ask for a new detection once
+    confidence drops below their threshold. That confidence is relative to
+    each track's own detection score, so weak detections do not force the
+    detector to run on the very next frame.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_misses=1, velocity_smoothing=0.5,
+                 confidence_decay=0.9):
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.velocity_smoothing = velocity_smoothing
+        self.confidence_decay = confidence_decay
+        self.next_id = 0
+
+        self.boxes = np.zeros((0, 4), dtype='float32')
+        self.velocities = np.zeros((0, 4), dtype='float32')
+        self.last_boxes = np.zeros((0, 4), dtype='float32')
+        self.scores = np.zeros((0,), dtype='float32')
+        self.classes = np.zeros((0,), dtype='int32')
+        self.ids = np.zeros((0,), dtype='int32')
+        self.age = np.zeros((0,), dtype='int32')  # frames since last matched
+        self.misses = np.zeros((0,), dtype='int32')
+
+    @property
+    def confidence(self):
+        """Lowest decay since a track was last detected, 1 when nothing is
+        tracked."""
+        if not len(self.age):
+            return 1.
+        return float(self.confidence_decay ** self.age.max())
+
+    def _outputs(self):
+        return self.boxes.copy(), self.scores.copy(), self.classes.copy(), \
+            self.ids.copy()
+
+    def _step(self):
+        self.boxes = self.boxes + self.velocities
+        self.scores = self.scores * self.confidence_decay
+        self.age += 1
+
+    def predict(self):
+        """Advance every track one frame without a detection."""
+        self._step()
+        return self._outputs()
+
+    def _match(self, boxes, classes):
+        iou = pairwise_iou(self.boxes, boxes)
+        iou[self.classes[:, None] != classes[None, :]] = 0.
+        pairs = np.argwhere(iou >= self.iou_threshold)
+        order = np.argsort(-iou[pairs[:, 0], pairs[:, 1]], kind='stable')
+
+        # Greedy assignment, best overlapping pairs first.
+        track_used = np.zeros(len(self.boxes), dtype=bool)
+        detection_used = np.zeros(len(boxes), dtype=bool)
+        matches = []
+        for t, d in pairs[order]:
+            if not track_used[t] and not detection_used[d]:
+                track_used[t] = detection_used[d] = True
+                matches.append((t, d))
+        matches = np.array(matches, dtype='int32').reshape(-1, 2)
+        return matches, track_used, detection_used
+
+    def update(self, boxes, scores, classes):
+        """Advance one frame and correct the tracks with fresh detections.
+
+        Returns (boxes, scores, classes, track_ids) of the current tracks.
+        """
+        boxes = np.asarray(boxes, dtype='float32').reshape(-1, 4)
+        scores = np.asarray(scores, dtype='float32')
+        classes = np.asarray(classes, dtype='int32')
+        self._step()
+
+        matches, track_used, detection_used = self._match(boxes, classes)
+        t, d = matches[:, 0], matches[:, 1]
+        observed = (boxes[d] - self.last_boxes[t]) / self.age[t, None]
+        self.velocities[t] = self.velocity_smoothing * observed + \
+            (1 - self.velocity_smoothing) * self.velocities[t]
+        self.boxes[t] = boxes[d]
+        self.last_boxes[t] = boxes[d]
+        self.scores[t] = scores[d]
+        self.age[t] = 0
+        self.misses[t] = 0
+        self.misses[~track_used] += 1
+
+        keep = self.misses <= self.max_misses
+        new = ~detection_used
+        num_new = int(new.sum())
+        new_ids = np.arange(self.next_id, self.next_id + num_new,
+                            dtype='int32')
+        self.next_id += num_new
+
+        self.boxes = np.concatenate([self.boxes[keep], boxes[new]])
+        self.velocities = np.concatenate(
+                [self.velocities[keep], np.zeros((num_new, 4), 'float32')])
+        self.last_boxes = np.concatenate([self.last_boxes[keep], boxes[new]])
+        self.scores = np.concatenate([self.scores[keep], scores[new]])
+        self.classes = np.concatenate([self.classes[keep], classes[new]])
+        self.ids = np.concatenate([self.ids[keep], new_ids])
+        self.age = np.concatenate(
+                [self.age[keep], np.zeros(num_new, 'int32')])
+        self.misses = np.concatenate(
+                [self.misses[keep], np.zeros(num_new, 'int32')])
+        return self._outputs()
@@ -119,3 +119,157 @@ def get_random_data(annotation_line, input_shape, random=True, max_boxes=20, jit
         box_data[:len(box)] = box
 
     return image_data, box_data
+
+def pairwise_iou(boxes1, boxes2):
+    '''iou of every box in boxes1 with every box in boxes2
+
+    Boxes are (top, left, bottom, right) arrays of shape (N, 4) and (M, 4),
+    the result has shape (N, M).
+    '''
+    boxes1 = np.asarray(boxes1, dtype='float32').reshape(-1, 4)
+    boxes2 = np.asarray(boxes2, dtype='float32').reshape(-1, 4)
+    mins = np.maximum(boxes1[:, None, :2], boxes2[None, :, :2])
+    maxes = np.minimum(boxes1[:, None, 2:], boxes2[None, :, 2:])
+    intersect_hw = np.maximum(maxes - mins, 0.)
+    intersect_area = intersect_hw[..., 0] * intersect_hw[..., 1]
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    union = area1[:, None] + area2[None, :] - intersect_area
+    return intersect_area / np.maximum(union, 1e-9)
+
+def rect_input_size(image_size, max_side=416):
+    '''smallest multiple of 32 (w, h) holding image_size scaled to max_side
+
+    Used to letterbox widescreen frames to e.g. 416x256 instead of padding
+    them out to a 416x416 square.
+    '''
+    iw, ih = image_size
+    # Integer ceil, float scaling overshoots to the next multiple of 32.
+    long_side = max(iw, ih)
+    w = -(-iw * max_side // long_side // 32) * 32
+    h = -(-ih * max_side // long_side // 32) * 32
+    return int(w), int(h)
+
+def non_max_suppression(boxes, scores, classes=None, iou_threshold=.5,
+                        max_boxes=None):
+    '''indices of the boxes kept by greedy non max suppression, best first
+
+    With classes given boxes of different classes never suppress each
+    other: they are shifted apart by a per class offset, so a single pass
+    covers every class.
+    '''
+    boxes = np.asarray(boxes, dtype='float32').reshape(-1, 4)
+    scores = np.asarray(scores, dtype='float32')
+    if len(boxes) == 0:
+        return np.zeros((0,), dtype='int64')
+    if classes is not None:
+        offset = np.abs(boxes).max() + 1.
+        boxes = boxes + (np.asarray(classes, dtype='float32') * offset)[:, None]
+
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    order = np.argsort(-scores, kind='stable')
+    keep = []
+    while len(order) > 0:
+        i = order[0]
+        keep.append(i)
+        if max_boxes is not None and len(keep) >= max_boxes:
+            break
+        rest = order[1:]
+        mins = np.maximum(boxes[i, :2], boxes[rest, :2])
+        maxes = np.minimum(boxes[i, 2:], boxes[rest, 2:])
+        intersect_hw = np.maximum(maxes - mins, 0.)
+        intersect_area = intersect_hw[:, 0] * intersect_hw[:, 1]
+        iou = intersect_area / np.maximum(
+                areas[i] + areas[rest] - intersect_area, 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype='int64')
+
+def fast_non_max_suppression(boxes, scores, classes=None, iou_threshold=.5,
+                             max_boxes=None, top_k=200):
+    '''indices kept by matrix (Fast) NMS over the top_k scores, best first
+
+    Every box is checked against all better boxes at once, including ones
+    that are suppressed themselves. That keeps no more boxes than greedy
+    non_max_suppression and often a few less, in one vectorized step.
+    '''
+    boxes = np.asarray(boxes, dtype='float32').reshape(-1, 4)
+    scores = np.asarray(scores, dtype='float32')
+    if len(boxes) == 0:
+        return np.zeros((0,), dtype='int64')
+    if classes is not None:
+        offset = np.abs(boxes).max() + 1.
+        boxes = boxes + (np.asarray(classes, dtype='float32') * offset)[:, None]
+
+    order = np.argsort(-scores, kind='stable')[:top_k]
+    iou = np.triu(pairwise_iou(boxes[order], boxes[order]), k=1)
+    keep = order[iou.max(axis=0) <= iou_threshold]
+    return keep[:max_boxes] if max_boxes is not None else keep
+
+def tile_origins(image_size, tile_size, overlap=.2):
+    '''(left, top) of overlapping tiles covering an image of image_size (w, h)
+
+    tile_size is (w, h). The last tile of every row and column is aligned to
+    the image border, so no tile hangs over the image edge unless the image
+    is smaller than a tile.
+    '''
+    def starts(length, tile):
+        if length <= tile:
+            return [0]
+        step = max(1, int(tile * (1 - overlap)))
+        positions = list(range(0, length - tile, step))
+        return positions + [length - tile]
+
+    return [(left, top) for top in starts(image_size[1], tile_size[1])
+            for left in starts(image_size[0], tile_size[0])]
+
+def average_precision(recall, precision):
+    '''area under the precision recall curve, all point interpolation'''
+    recall = np.concatenate(([0.], recall, [1.]))
+    precision = np.concatenate(([0.], precision, [0.]))
+    # Make precision monotonically decreasing from right to left.
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    steps = np.where(recall[1:] != recall[:-1])[0]
+    return np.sum((recall[steps + 1] - recall[steps]) * precision[steps + 1])
+
+def mean_average_precision(detections, ground_truths, num_classes,
+                           iou_threshold=.5):
+    '''mAP over classes that have ground truth, and the per class AP
+
+    detections holds (boxes, scores, classes) and ground_truths holds
+    (boxes, classes) for every image, boxes are (top, left, bottom, right).
+    A detection is a true positive when it overlaps a not yet matched ground
+    truth of its class by more than iou_threshold, best scores match first.
+    '''
+    class_ap = {}
+    for c in range(num_classes):
+        scores, hits = [], []
+        num_truths = 0
+        for (boxes, box_scores, classes), (truths, truth_classes) in zip(
+                detections, ground_truths):
+            truths = np.asarray(truths).reshape(-1, 4)[
+                    np.asarray(truth_classes) == c]
+            num_truths += len(truths)
+            mask = np.asarray(classes) == c
+            boxes, box_scores = np.asarray(boxes)[mask], \
+                np.asarray(box_scores)[mask]
+            order = np.argsort(-box_scores, kind='stable')
+            iou = pairwise_iou(boxes[order], truths)
+            matched = np.zeros(len(truths), dtype=bool)
+            for i in range(len(order)):
+                hit = False
+                if len(truths):
+                    overlaps = np.where(matched, -1., iou[i])
+                    j = np.argmax(overlaps)
+                    if overlaps[j] > iou_threshold:
+                        matched[j] = hit = True
+                scores.append(box_scores[order[i]])
+                hits.append(hit)
+        if num_truths == 0:
+            continue
+        order = np.argsort(-np.array(scores), kind='stable')
+        true_positives = np.cumsum(np.array(hits, dtype='float32')[order])
+        recall = true_positives / num_truths
+        precision = true_positives / np.arange(1, len(order) + 1)
+        class_ap[c] = average_precision(recall, precision)
+    mean_ap = np.mean(list(class_ap.values())) if class_ap else 0.
+    return mean_ap, class_ap
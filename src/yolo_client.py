@@ -0,0 +1,66 @@
+"""
+Small client for yolo_server.py, sends images concurrently and reports latency
+"""
+
+import argparse
+import json
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as timer
+
+
+def detect_remote(path, url='http://127.0.0.1:8000/detect'):
+    with open(path, 'rb') as f:
+        data = f.read()
+    request = urllib.request.Request(
+            url, data=data, headers={'Content-Type': 'application/octet-stream'})
+    start = timer()
+    with urllib.request.urlopen(request) as response:
+        result = json.loads(response.read().decode('utf-8'))
+    return result, timer() - start
+
+
+def _main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--url', type=str, default='http://127.0.0.1:8000/detect',
+        help='Detection endpoint, default http://127.0.0.1:8000/detect'
+    )
+
+    parser.add_argument(
+        '--concurrency', type=int, default=8,
+        help='Number of requests in flight, default 8'
+    )
+
+    parser.add_argument(
+        '--repeat', type=int, default=1,
+        help='Send every image this many times, default 1'
+    )
+
+    parser.add_argument(
+        'images', nargs='+', type=str,
+        help='Image files to send'
+    )
+
+    FLAGS = parser.parse_args()
+    paths = FLAGS.images * FLAGS.repeat
+
+    start = timer()
+    with ThreadPoolExecutor(FLAGS.concurrency) as executor:
+        results = list(executor.map(lambda p: detect_remote(p, FLAGS.url),
+                                    paths))
+    elapsed = timer() - start
+
+    for path, (result, latency) in zip(paths, results):
+        labels = [d['label'] for d in result['detections']]
+        print('{}: {} boxes in {:.0f} ms {}'.format(path, len(labels),
+                                                    1000 * latency, labels))
+    latencies = sorted(latency for _, latency in results)
+    print('{} requests in {:.2f} s, {:.1f} images/s, p50 {:.0f} ms, '
+          'max {:.0f} ms'.format(len(paths), elapsed, len(paths) / elapsed,
+                                 1000 * latencies[len(latencies) // 2],
+                                 1000 * latencies[-1]))
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,167 @@
+"""
+Long running HTTP detection server backed by one YOLO model
+
+POST an encoded image (JPEG, PNG, ...) to /detect and get the detections
+back as JSON. Concurrent requests are grouped into micro-batches, so one
+loaded model serves every client. GET /stats reports the batching figures.
+"""
+
+import argparse
+import io
+import json
+import queue
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+from src.yolo import YOLO
+from src.batching import MicroBatcher
+
+
+class DetectionHandler(BaseHTTPRequestHandler):
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self._send_json(404, {'error': 'not found'})
+            return
+        batcher = self.server.batcher
+        self._send_json(200, {'batches': batcher.batches,
+                              'images': batcher.items,
+                              'mean_batch_size': batcher.mean_batch_size,
+                              'queued': batcher.queue.qsize()})
+
+    def do_POST(self):
+        if self.path != '/detect':
+            self._send_json(404, {'error': 'not found'})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            image = Image.open(io.BytesIO(self.rfile.read(length)))
+            image = image.convert('RGB')
+        except Exception:
+            self._send_json(400, {'error': 'could not decode image'})
+            return
+
+        try:
+            future = self.server.batcher.submit(image)
+        except queue.Full:
+            self._send_json(503, {'error': 'server busy'})
+            return
+        except RuntimeError:
+            self._send_json(503, {'error': 'server shutting down'})
+            return
+        try:
+            boxes, scores, classes = future.result(
+                    timeout=self.server.request_timeout)
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+            return
+
+        class_names = self.server.class_names
+        self._send_json(200, {
+                'width': image.width,
+                'height': image.height,
+                'detections': [
+                        {'box': [float(x) for x in box],  # top, left, bottom, right
+                         'score': float(score),
+                         'class': int(c),
+                         'label': class_names[c]}
+                        for box, score, c in zip(boxes, scores, classes)]})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class DetectionServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, yolo, max_batch=8, max_wait=0.01,
+                 max_queue=64, request_timeout=30., verbose=False):
+        super().__init__(address, DetectionHandler)
+        self.class_names = yolo.class_names
+        self.batcher = MicroBatcher(yolo.detect_images, max_batch=max_batch,
+                                    max_wait=max_wait, max_queue=max_queue)
+        self.request_timeout = request_timeout
+        self.verbose = verbose
+
+    def serve_forever(self, poll_interval=0.5):
+        self.batcher.start()
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            self.batcher.stop()
+
+
+def _main():
+    # class YOLO defines the default value, so suppress any default here
+    parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS)
+    '''
+    Command line options
+    '''
+    parser.add_argument(
+        '--model_path', type=str,
+        help='path to model weight file, default ' + YOLO.get_defaults("model_path")
+    )
+
+    parser.add_argument(
+        '--anchors_path', type=str,
+        help='path to anchor definitions, default ' + YOLO.get_defaults("anchors_path")
+    )
+
+    parser.add_argument(
+        '--classes_path', type=str,
+        help='path to class definitions, default ' + YOLO.get_defaults("classes_path")
+    )
+
+    parser.add_argument(
+        '--host', type=str, default='127.0.0.1',
+        help='Address to listen on, default 127.0.0.1'
+    )
+
+    parser.add_argument(
+        '--port', type=int, default=8000,
+        help='Port to listen on, default 8000'
+    )
+
+    parser.add_argument(
+        '--max_batch', type=int, default=8,
+        help='Maximum number of images per session call, default 8'
+    )
+
+    parser.add_argument(
+        '--max_wait', type=float, default=0.01,
+        help='Seconds to wait for a batch to fill up, default 0.01'
+    )
+
+    parser.add_argument(
+        '--max_queue', type=int, default=64,
+        help='Pending requests before answering 503, default 64'
+    )
+
+    FLAGS = vars(parser.parse_args())
+    host, port = FLAGS.pop('host'), FLAGS.pop('port')
+    batching = {k: FLAGS.pop(k) for k in ('max_batch', 'max_wait', 'max_queue')}
+
+    yolo = YOLO(**FLAGS)
+    server = DetectionServer((host, port), yolo, **batching)
+    print('Serving detections on http://{}:{}/detect'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        yolo.close_session()
+
+
+if __name__ == '__main__':
+    _main()
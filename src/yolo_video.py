@@ -1,11 +1,12 @@
 import argparse
-from src.yolo import YOLO, detect_video
+from src.yolo import YOLO, detect_video, detect_video_pipelined
+from src.yolo3.motion import MotionGate
 from PIL import Image
 from matplotlib import pyplot as plt
 import numpy as np
 
 
-def detect_img(yolo):
+def detect_img(yolo, tiled=False):
     while True:
         img = input('Input image filename:')
         try:
@@ -14,7 +15,11 @@ def detect_img(yolo):
             print('Open Error! Try again!')
             continue
         else:
-            r_image = yolo.annotate_image(image, *yolo.detect_image(image))
+            if tiled:
+                detections = yolo.detect_image_tiled(image)
+            else:
+                detections = yolo.detect_image(image)
+            r_image = yolo.annotate_image(image, *detections)
             plt.figure()
             plt.imshow(np.asarray(r_image))
             plt.show()
@@ -49,10 +54,120 @@ if __name__ == '__main__':
         help='Number of GPU to use, default ' + str(YOLO.get_defaults("gpu_num"))
     )
 
+    parser.add_argument(
+        '--intra_op_threads', type=int,
+        help='Threads used inside one TF op, 0 lets TF decide, default ' + str(YOLO.get_defaults("intra_op_threads"))
+    )
+
+    parser.add_argument(
+        '--inter_op_threads', type=int,
+        help='TF ops run in parallel, 0 lets TF decide, default ' + str(YOLO.get_defaults("inter_op_threads"))
+    )
+
+    parser.add_argument(
+        '--graph_optimization', type=str, choices=['default', 'aggressive', 'off'],
+        help='Grappler graph optimization level, default ' + YOLO.get_defaults("graph_optimization")
+    )
+
+    parser.add_argument(
+        '--xla_jit', action="store_true",
+        help='Compile the graph with XLA JIT'
+    )
+
+    parser.add_argument(
+        '--fold_batchnorm', action="store_true",
+        help='Fold BatchNormalization into the convolutions before inference'
+    )
+
+    parser.add_argument(
+        '--cascade_model_path', type=str,
+        help='Accurate model run only when the fast --model_path is unsure, enables the cascade'
+    )
+
+    parser.add_argument(
+        '--cascade_anchors_path', type=str,
+        help='Anchors of the cascade model, default ' + YOLO.get_defaults("cascade_anchors_path")
+    )
+
+    parser.add_argument(
+        '--cascade_band', type=float, nargs=2,
+        help='Fast model scores in [low, high) escalate to the cascade model, default ' + str(YOLO.get_defaults("cascade_band"))
+    )
+
+    parser.add_argument(
+        '--cascade_refresh', type=int,
+        help='Also escalate after this many frames without escalation, 0 never, default ' + str(YOLO.get_defaults("cascade_refresh"))
+    )
+
+    parser.add_argument(
+        '--score', type=float,
+        help='Default score threshold, default ' + str(YOLO.get_defaults("score"))
+    )
+
+    parser.add_argument(
+        '--iou', type=float,
+        help='Default NMS IoU threshold, default ' + str(YOLO.get_defaults("iou"))
+    )
+
+    parser.add_argument(
+        '--nms_mode', type=str, choices=['class_aware', 'per_class'],
+        help='NMS over all classes at once or one NMS per class, default ' + YOLO.get_defaults("nms_mode")
+    )
+
+    parser.add_argument(
+        '--max_boxes', type=int,
+        help='Maximum number of detections (per class with per_class NMS), default ' + str(YOLO.get_defaults("max_boxes"))
+    )
+
+    parser.add_argument(
+        '--pre_nms_top_k', type=int,
+        help='Boxes per image scored and passed to NMS, highest objectness first, 0 for no cap, default ' + str(YOLO.get_defaults("pre_nms_top_k"))
+    )
+
+    parser.add_argument(
+        '--rect_inference', action="store_true",
+        help='Letterbox to the smallest multiple of 32 rectangle fitting the aspect ratio instead of a square'
+    )
+
+    parser.add_argument(
+        '--preprocess', action="store_true",
+        help='Letterbox and normalize raw uint8 frames inside the graph'
+    )
+
+    parser.add_argument(
+        '--input_channels', type=str, choices=['RGB', 'BGR'],
+        help='Channel order of raw frames with --preprocess, default ' + YOLO.get_defaults("input_channels")
+    )
+
+    parser.add_argument(
+        '--pipeline', default=False, action="store_true",
+        help='Run video decode, inference and annotation on separate threads'
+    )
+
+    parser.add_argument(
+        '--detect_every', type=int, default=1,
+        help='Run the detector every N video frames and track in between, default 1'
+    )
+
+    parser.add_argument(
+        '--min_track_confidence', type=float, default=0.5,
+        help='Run the detector early when a track decays below this fraction of its detection score, default 0.5'
+    )
+
+    parser.add_argument(
+        '--motion_gate', default=False, action="store_true",
+        help='Skip inference and reuse the last detections while the scene is static'
+    )
+
     parser.add_argument(
         '--image', default=False, action="store_true",
         help='Image detection mode, will ignore all positional arguments'
     )
+
+    parser.add_argument(
+        '--tiled', default=False, action="store_true",
+        help='In image mode, detect on overlapping full resolution tiles'
+    )
     '''
     Command line positional arguments -- for video detection mode
     '''
@@ -75,8 +190,16 @@ if __name__ == '__main__':
         print("Image detection mode")
         if "input" in FLAGS:
             print(" Ignoring remaining command line arguments: " + FLAGS.input + "," + FLAGS.output)
-        detect_img(YOLO(**vars(FLAGS)))
+        detect_img(YOLO(**vars(FLAGS)), tiled=FLAGS.tiled)
     elif "input" in FLAGS:
-        detect_video(YOLO(**vars(FLAGS)), FLAGS.input, FLAGS.output)
+        motion_gate = MotionGate() if FLAGS.motion_gate else None
+        if FLAGS.pipeline:
+            detect_video_pipelined(YOLO(**vars(FLAGS)), FLAGS.input, FLAGS.output,
+                                   motion_gate=motion_gate)
+        else:
+            detect_video(YOLO(**vars(FLAGS)), FLAGS.input, FLAGS.output,
+                         detect_every=FLAGS.detect_every,
+                         min_track_confidence=FLAGS.min_track_confidence,
+                         motion_gate=motion_gate)
     else:
         print("Must specify at least video_input_path.  See usage with --help.")